@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+'''
+    benchmark of how long importing markupwiki takes
+
+    Every measurement runs in a fresh interpreter using the example project's
+    settings, so nothing is already imported.
+
+    Usage::
+
+        python benchmarks/imports.py --repeat 20 --output imports.json
+
+    For each module the median and minimum time to import it (Django's own
+    startup excluded) are reported, along with the markup libraries it
+    imported.  ``first_render`` is the time to import the models and render
+    a markdown article once.
+'''
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MARKUP_LIBRARIES = ('markdown', 'docutils', 'textile', 'pygments')
+
+SETUP = '''
+import os, sys, time, json
+sys.path.insert(0, %r)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'example.settings')
+from django.conf import settings
+settings.INSTALLED_APPS
+import django.db.models
+start = time.time()
+'''
+
+CASES = [
+    ('urls', 'import markupwiki.urls'),
+    ('models', 'import markupwiki.models'),
+    ('views', 'import markupwiki.views'),
+    ('feeds', 'import markupwiki.feeds'),
+    ('first_render', 'from markupwiki.models import render_markup\n'
+                     'render_markup("# title\\n\\nsome *text*", "markdown", '
+                     'wiki_links=False)'),
+]
+
+REPORT = '''
+elapsed = time.time() - start
+print(json.dumps({'seconds': elapsed,
+                  'libraries': [m for m in %r if m in sys.modules]}))
+'''
+
+
+def time_case(code):
+    script = SETUP % ROOT + code + REPORT % (MARKUP_LIBRARIES,)
+    output = subprocess.check_output([sys.executable, '-c', script])
+    return json.loads(output.decode('utf8').strip().splitlines()[-1])
+
+
+def run(options):
+    results = []
+    for name, code in CASES:
+        if options.only and name not in options.only:
+            continue
+        runs = [time_case(code) for i in range(options.repeat)]
+        times = sorted(r['seconds'] * 1000 for r in runs)
+        result = {'name': name,
+                  'repeat': options.repeat,
+                  'median_ms': round(times[len(times) // 2], 3),
+                  'min_ms': round(times[0], 3),
+                  'libraries': runs[-1]['libraries']}
+        results.append(result)
+        print('%-14s median %8.2fms  min %8.2fms  imports %s' % (
+            name, result['median_ms'], result['min_ms'],
+            ', '.join(result['libraries']) or '-'))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='fresh interpreters started per measurement')
+    parser.add_argument('--only', nargs='*',
+                        help='names of the measurements to run')
+    parser.add_argument('--output', help='write results to this JSON file')
+    options = parser.parse_args()
+
+    results = run(options)
+
+    if options.output:
+        import django
+        with open(options.output, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'django': django.get_version(),
+                       'options': vars(options),
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
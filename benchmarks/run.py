@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+'''
+    benchmarks for markupwiki's hot paths
+
+    Builds a generated wiki in a throwaway test database using the example
+    project's settings and times the main views through the test client.
+
+    Usage::
+
+        python benchmarks/run.py --articles 200 --revisions 20 --output results.json
+
+    For every benchmark the latency percentiles, the number of SQL queries per
+    request and (on Pythons with tracemalloc) the peak memory allocated while
+    handling a request are reported.  --output writes the same numbers as JSON
+    so that results from different releases can be compared.
+'''
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'example.settings')
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+
+def make_body(rng, titles, paragraphs, link_density):
+    ''' return a random markdown body where roughly link_density of the words
+        are [[links]] to other articles '''
+    lines = []
+    for p in range(paragraphs):
+        lines.append('## Section %s' % p)
+        words = []
+        for w in range(60):
+            if rng.random() < link_density:
+                words.append('[[%s]]' % rng.choice(titles))
+            else:
+                words.append(rng.choice(WORDS))
+        lines.append(' '.join(words))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def build_corpus(options, rng):
+    from django.contrib.auth.models import User
+    from markupwiki.models import Article, ArticleVersion
+
+    user = User.objects.create_user('bench', 'bench@example.com', 'bench')
+    User.objects.create_superuser('benchadmin', 'admin@example.com', 'bench')
+
+    titles = ['Section_%s/Article_%s' % (i % 10, i)
+              for i in range(options.articles)]
+    for title in titles:
+        article = Article.objects.create(title=title, creator=user)
+        for n in range(options.revisions):
+            ArticleVersion.objects.create(
+                article=article, author=user, number=n,
+                body=make_body(rng, titles, options.paragraphs,
+                               options.link_density))
+    return titles
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def measure(name, func, iterations):
+    ''' call func iterations times and summarize latency, queries and memory '''
+    from django.db import connection, reset_queries
+
+    latencies, queries, peaks = [], [], []
+    for i in range(iterations):
+        reset_queries()
+        if tracemalloc:
+            tracemalloc.start()
+        start = time.time()
+        func(i)
+        latencies.append((time.time() - start) * 1000)
+        if tracemalloc:
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        queries.append(len(connection.queries))
+
+    result = {
+        'name': name,
+        'iterations': iterations,
+        'latency_ms': dict(('p%s' % p, round(percentile(latencies, p), 3))
+                           for p in (50, 90, 99)),
+        'latency_ms_max': round(max(latencies), 3),
+        'queries_mean': round(sum(queries) / float(len(queries)), 2),
+        'queries_max': max(queries),
+    }
+    if peaks:
+        result['alloc_peak_bytes'] = max(peaks)
+    return result
+
+
+def run(options):
+    from django.conf import settings
+    from django.core.cache import cache
+    from django.db import connection
+    from django.test.client import Client
+    from django.test.utils import setup_test_environment, teardown_test_environment
+    from markupwiki import ratelimit
+    from markupwiki.utils import make_wiki_links
+
+    setup_test_environment()
+    old_name = settings.DATABASES['default']['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    # record queries even though DEBUG is off in the test environment
+    connection.use_debug_cursor = True
+    # the edit benchmark makes far more edits than a person could
+    ratelimit.EDITOR_RATE_LIMIT = ratelimit.MODERATOR_RATE_LIMIT = None
+
+    try:
+        rng = random.Random(options.seed)
+        titles = build_corpus(options, rng)
+        cache.clear()
+
+        anon = Client()
+        editor = Client()
+        editor.login(username='benchadmin', password='bench')
+        n = options.iterations
+
+        def title(i):
+            return titles[i % len(titles)]
+
+        def view_cold(i):
+            cache.clear()
+            anon.get('/wiki/%s/' % title(i))
+
+        def edit(i):
+            editor.post('/wiki/%s/edit/' % title(i),
+                        {'body': make_body(rng, titles, options.paragraphs,
+                                           options.link_density),
+                         'comment': 'benchmark', 'body_markup_type': 'markdown'})
+
+        def diff(i):
+            anon.get('/wiki/%s/diff/' % title(i),
+                     {'from': 0, 'to': options.revisions - 1,
+                      'mode': options.diff_mode})
+
+        body = make_body(rng, titles, options.paragraphs, options.link_density)
+
+        benchmarks = [
+            ('view_article_cold', view_cold),
+            ('view_article_warm', lambda i: anon.get('/wiki/%s/' % title(i))),
+            ('view_revision',
+             lambda i: anon.get('/wiki/%s/history/0/' % title(i))),
+            ('history', lambda i: anon.get('/wiki/%s/history/' % title(i))),
+            ('diff', diff),
+            ('wiki_links', lambda i: make_wiki_links(body)),
+            ('rss_global', lambda i: anon.get('/wiki/rss/')),
+            ('rss_article', lambda i: anon.get('/wiki/%s/rss/' % title(i))),
+            ('edit_post', edit),
+        ]
+        if options.only:
+            benchmarks = [b for b in benchmarks if b[0] in options.only]
+
+        results = []
+        for name, func in benchmarks:
+            result = measure(name, func, n)
+            results.append(result)
+            print('%-20s p50 %8.2fms  p90 %8.2fms  p99 %8.2fms  '
+                  'queries %6.1f' % (name, result['latency_ms']['p50'],
+                                     result['latency_ms']['p90'],
+                                     result['latency_ms']['p99'],
+                                     result['queries_mean']))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--articles', type=int, default=100)
+    parser.add_argument('--revisions', type=int, default=10)
+    parser.add_argument('--paragraphs', type=int, default=5,
+                        help='paragraphs per generated body')
+    parser.add_argument('--link-density', type=float, default=0.05,
+                        help='fraction of words that are wiki links')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--diff-mode', default='context')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', nargs='*',
+                        help='names of the benchmarks to run')
+    parser.add_argument('--output', help='write results to this JSON file')
+    options = parser.parse_args()
+
+    results = run(options)
+
+    if options.output:
+        import django
+        with open(options.output, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'django': django.get_version(),
+                       'options': vars(options),
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
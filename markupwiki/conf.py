@@ -0,0 +1,138 @@
+'''
+    lazily resolved configuration of the markup pipeline
+
+    ``conf`` looks MARKUPWIKI_ settings up the first time they're used and
+    caches them until ``conf.reset()`` is called.  markupwiki's tests connect
+    ``reset_on_setting_changed`` to django's setting_changed signal, projects
+    that change settings in their own tests can do the same.
+
+    Resetting changes how ``models.render_markup`` renders and which
+    functions render each markup type.  The markup type names and
+    MARKUPWIKI_ESCAPE_HTML are passed to ArticleVersion's MarkupField when
+    the models are loaded though, so saving a version keeps using the values
+    from then.
+
+    The markup functions articles are rendered with
+    are built on first render, so importing markupwiki doesn't import
+    markdown, docutils or textile.  Entries of MARKUPWIKI_MARKUP_TYPES can be
+    given as dotted paths, eg. ``('markdown', 'markdown.markdown')``, which
+    are imported on first use as well.
+
+    django-markupfield (imported by the models) still checks which markup
+    libraries are installed when it's imported, only markupwiki's own
+    defaults avoid importing them.
+'''
+
+import pkgutil
+from django.conf import settings
+from django.utils.html import escape, linebreaks, urlize
+from django.utils.importlib import import_module
+from markupwiki.sections import section_markup_wrapper
+from markupwiki.utils import wikify_markup_wrapper
+
+def _render_markdown(text):
+    return conf.markdown_filter(text)
+
+def _render_rest(text):
+    from docutils.core import publish_parts
+    overrides = getattr(settings, 'RESTRUCTUREDTEXT_FILTER_SETTINGS', {})
+    return publish_parts(source=text, writer_name='html4css1',
+                         settings_overrides=overrides)['fragment']
+
+def _render_textile(text):
+    import textile
+    return textile.textile(text, encoding='utf-8', output='utf-8')
+
+def _default_markup_types():
+    ''' the same markup types markupfield would offer, found without
+        importing the libraries '''
+    types = [('html', lambda text: text),
+             ('plain', lambda text: linebreaks(urlize(escape(text))))]
+    for name, module, func in (('markdown', 'markdown', _render_markdown),
+                               ('restructuredtext', 'docutils',
+                                _render_rest),
+                               ('textile', 'textile', _render_textile)):
+        if pkgutil.find_loader(module):
+            types.append((name, func))
+    return types
+
+def _resolve(func):
+    if isinstance(func, basestring):
+        module, name = func.rsplit('.', 1)
+        func = getattr(import_module(module), name)
+    return func
+
+class WikiConf(object):
+    ''' MARKUPWIKI_ settings, each looked up once '''
+
+    defaults = {
+        'DEFAULT_MARKUP_TYPE': 'markdown',
+        'ESCAPE_HTML': True,
+        'MARKUP_TYPES': None,
+        'EDITOR_TEST_FUNC': lambda u: u.is_authenticated(),
+        'MODERATOR_TEST_FUNC': lambda u: u.is_staff,
+    }
+
+    def __getattr__(self, name):
+        # only called for names that aren't cached in __dict__ yet
+        if name not in self.defaults:
+            raise AttributeError(name)
+        value = getattr(settings, 'MARKUPWIKI_' + name, self.defaults[name])
+        if name == 'MARKUP_TYPES' and value is None:
+            value = _default_markup_types()
+        self.__dict__[name] = value
+        return value
+
+    def reset(self):
+        self.__dict__.clear()
+
+    @property
+    def markup_names(self):
+        return [name for name, func in self.MARKUP_TYPES]
+
+    @property
+    def markdown_filter(self):
+        if 'markdown_filter' not in self.__dict__:
+            import markdown
+            func = markdown.markdown
+            # use pygments to highlight code blocks, like markupfield
+            if pkgutil.find_loader('pygments'):
+                try:
+                    from markdown.extensions.codehilite import makeExtension  # noqa
+                    func = lambda text: markdown.markdown(
+                        text, extensions=['codehilite(css_class=highlight)'])
+                except ImportError:
+                    pass
+            self.__dict__['markdown_filter'] = func
+        return self.__dict__['markdown_filter']
+
+    def get_markup_func(self, markup_type, wiki_links=True):
+        ''' return the function rendering markup_type, built on first use
+            from MARKUPWIKI_MARKUP_TYPES with section by section rendering
+            and (unless wiki_links is False) make_wiki_links added '''
+        funcs = self.__dict__.get('markup_funcs')
+        if funcs is None:
+            funcs = self.__dict__['markup_funcs'] = {}
+        key = (markup_type, wiki_links)
+        if key not in funcs:
+            func = section_markup_wrapper(
+                markup_type, _resolve(dict(self.MARKUP_TYPES)[markup_type]))
+            if wiki_links:
+                func = wikify_markup_wrapper(func)
+            funcs[key] = func
+        return funcs[key]
+
+conf = WikiConf()
+
+def lazy_markup_func(markup_type, wiki_links=True):
+    ''' return a function that renders with conf's markup_type function,
+        for markupfield which wants the functions when models are loaded '''
+    def render(text):
+        return conf.get_markup_func(markup_type, wiki_links)(text)
+    return render
+
+def reset_on_setting_changed(sender, setting, **kwargs):
+    ''' receiver for django.test.signals.setting_changed, not connected here
+        so that loading markupwiki doesn't import django.test '''
+    if setting.startswith('MARKUPWIKI_'):
+        conf.reset()
@@ -0,0 +1,167 @@
+'''
+    html diffs between article versions
+
+    Three modes are supported:
+
+    full    - side by side table of the whole article (difflib.HtmlDiff)
+    context - side by side table showing only changed lines and their context
+    inline  - single column diff with word level highlighting of changes
+
+    All modes cap the amount of html produced.  The side by side tables are
+    only built for articles of up to MARKUPWIKI_DIFF_TABLE_MAX_LINES lines
+    without large changed blocks, since HtmlDiff can't be interrupted, larger
+    diffs are shown inline.  Inline mode falls back to a plain line diff once
+    MARKUPWIKI_DIFF_TIMEOUT seconds have been spent.
+
+    Diffs between versions are built in the ``markupwiki.workers`` pool, if
+    that takes too long a placeholder asking to reload is shown until the
+    worker has cached the diff.
+'''
+
+import re
+import time
+from itertools import groupby
+from operator import itemgetter
+from difflib import HtmlDiff, SequenceMatcher
+from django.conf import settings
+from django.utils.html import escape
+from markupwiki import rendercache, workers
+from markupwiki.instrumentation import timed
+
+DIFF_MODES = ('full', 'context', 'inline')
+DEFAULT_DIFF_MODE = getattr(settings, 'MARKUPWIKI_DEFAULT_DIFF_MODE', 'context')
+DIFF_CONTEXT_LINES = getattr(settings, 'MARKUPWIKI_DIFF_CONTEXT_LINES', 3)
+DIFF_MAX_LINES = getattr(settings, 'MARKUPWIKI_DIFF_MAX_LINES', 2000)
+DIFF_TIMEOUT = getattr(settings, 'MARKUPWIKI_DIFF_TIMEOUT', 2.0)
+DIFF_TABLE_MAX_LINES = getattr(settings, 'MARKUPWIKI_DIFF_TABLE_MAX_LINES', 500)
+# the time spent comparing a changed block word by word (or character by
+# character in HtmlDiff) grows with the square of its size, larger blocks are
+# shown as removed and added lines
+WORD_DIFF_MAX_WORDS = 1000
+TABLE_MAX_BLOCK_LINES = 20
+
+word_re = re.compile(r'(\s+|\w+|[^\w\s])', re.UNICODE)
+
+def _row(cls, marker, html):
+    return '<tr class="%s"><td class="diff_header">%s</td><td>%s</td></tr>' % (
+        cls, marker, html)
+
+def _chg_row(parts):
+    ''' row from (kind, text) pairs, merging neighbouring parts of a kind '''
+    html = []
+    for kind, group in groupby(parts, itemgetter(0)):
+        text = escape(''.join(part for k, part in group))
+        html.append('<%s>%s</%s>' % (kind, text, kind) if kind else text)
+    return _row('diff_chg', '~', ''.join(html))
+
+def _word_diff_rows(from_words, to_words):
+    ''' yield rows for a changed block with changed words marked up '''
+    tokens = []
+    matcher = SequenceMatcher(None, from_words, to_words, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            tokens.extend((None, word) for word in from_words[i1:i2])
+        else:
+            tokens.extend(('del', word) for word in from_words[i1:i2])
+            tokens.extend(('ins', word) for word in to_words[j1:j2])
+
+    line = []
+    for kind, word in tokens:
+        # newlines end the current row, even inside a change
+        for n, part in enumerate(word.split('\n')):
+            if n:
+                yield _chg_row(line)
+                line = []
+            if part:
+                line.append((kind, part))
+    yield _chg_row(line)
+
+def _line_diff_rows(from_lines, to_lines, context, timeout):
+    deadline = time.time() + timeout
+    matcher = SequenceMatcher(None, from_lines, to_lines)
+    for group in matcher.get_grouped_opcodes(context):
+        first, last = group[0], group[-1]
+        yield _row('diff_next', '@@', '-%s,%s +%s,%s' % (
+            first[1] + 1, last[2] - first[1], first[3] + 1, last[4] - first[3]))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in from_lines[i1:i2]:
+                    yield _row('diff_equal', '', escape(line))
+                continue
+            if tag == 'replace' and time.time() < deadline:
+                from_words = word_re.split('\n'.join(from_lines[i1:i2]))
+                to_words = word_re.split('\n'.join(to_lines[j1:j2]))
+                if max(len(from_words), len(to_words)) <= WORD_DIFF_MAX_WORDS:
+                    for row in _word_diff_rows(from_words, to_words):
+                        yield row
+                    continue
+            for line in from_lines[i1:i2]:
+                yield _row('diff_sub', '-', escape(line))
+            for line in to_lines[j1:j2]:
+                yield _row('diff_add', '+', escape(line))
+
+def _small_changes(from_lines, to_lines):
+    matcher = SequenceMatcher(None, from_lines, to_lines)
+    return all(max(i2 - i1, j2 - j1) <= TABLE_MAX_BLOCK_LINES
+               for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+               if tag == 'replace')
+
+def make_diff(from_text, to_text, mode=DEFAULT_DIFF_MODE,
+              max_lines=DIFF_MAX_LINES, timeout=DIFF_TIMEOUT):
+    ''' return (html, truncated) describing changes from from_text to to_text
+
+        truncated is True if the diff was cut off after max_lines rows
+    '''
+    from_lines = from_text.splitlines()
+    to_lines = to_text.splitlines()
+
+    # HtmlDiff builds the whole table in memory and has no time limit so
+    # only use it when the input is small enough that the output can't
+    # exceed max_lines and it has no large changed blocks
+    if mode in ('full', 'context') and max(len(from_lines), len(to_lines)) \
+            <= min(max_lines, DIFF_TABLE_MAX_LINES) and \
+            _small_changes(from_lines, to_lines):
+        table = HtmlDiff().make_table(from_lines, to_lines,
+                                      context=(mode == 'context'),
+                                      numlines=DIFF_CONTEXT_LINES)
+        return table, False
+
+    rows = []
+    truncated = False
+    for row in _line_diff_rows(from_lines, to_lines, DIFF_CONTEXT_LINES,
+                               timeout):
+        if len(rows) >= max_lines:
+            truncated = True
+            break
+        rows.append(row)
+    html = '<table class="diff diff_inline"><tbody>%s</tbody></table>' % (
+        ''.join(rows))
+    return html, truncated
+
+PENDING_DIFF = ('<table class="diff diff_pending"><tbody><tr><td>This diff is '
+                'still being prepared, reload the page in a moment.</td></tr>'
+                '</tbody></table>', False)
+
+def _diff_and_cache(key, from_text, to_text, mode):
+    result = make_diff(from_text, to_text, mode)
+    rendercache.get_render_cache().set(key, result, rendercache.CACHE_SECONDS)
+    return result
+
+@timed('diff')
+def get_version_diff(from_version, to_version, mode=DEFAULT_DIFF_MODE):
+    ''' make_diff between two ArticleVersions, cached since versions are
+        immutable '''
+    key = 'markupwiki_diff_%s_%s_%s' % (
+        rendercache.version_key(from_version.pk, from_version.timestamp),
+        rendercache.version_key(to_version.pk, to_version.timestamp), mode)
+    result = rendercache.get_render_cache().get(key)
+    if result is None:
+        from_text = from_version.restore_body().raw
+        to_text = to_version.restore_body().raw
+        try:
+            result = workers.run(_diff_and_cache,
+                                 (key, from_text, to_text, mode), key=key)
+        except workers.WorkerTimeout:
+            # diffing here would tie up the request just the same
+            result = PENDING_DIFF
+    return result
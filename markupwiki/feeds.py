@@ -1,29 +1,113 @@
 from django.contrib.syndication.views import Feed
+from django.db.models import Max
+from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404
-from markupwiki.models import Article, ArticleVersion
+from django.views.decorators.http import condition
+from markupwiki.models import Article, ArticleVersion, ARTICLE_STATUSES
+from markupwiki import recentchanges, rendercache
+from markupwiki.utils import title_key
 
-class LatestEditsFeed(Feed):
-    title = 'Recent Changes'
-    link = '/'
-    description = 'Latest Changes to Wiki Articles'
+STATUSES = dict((name.lower(), status) for status, name in ARTICLE_STATUSES)
+
+def _stamp(modified):
+    return modified.strftime('%Y%m%d%H%M%S%f') if modified else ''
+
+class ConditionalFeed(Feed):
+    ''' Feed that answers conditional GETs without building the feed and
+        caches the feed it builds for as long as its ETag stays the same
+
+        last_modified is looked up once per request and passed to etag '''
+
+    def etag(self, request, last_modified, *args, **kwargs):
+        return None
+
+    def last_modified(self, request, *args, **kwargs):
+        return None
 
-    def items(self):
-        return ArticleVersion.objects.order_by('-timestamp').select_related()[:20]
+    def __call__(self, request, *args, **kwargs):
+        last_modified = self.last_modified(request, *args, **kwargs)
+        etag = self.etag(request, last_modified, *args, **kwargs)
+
+        def view(request, *args, **kwargs):
+            if etag is None:
+                return super(ConditionalFeed, self).__call__(request, *args,
+                                                             **kwargs)
+            cache = rendercache.get_render_cache()
+            key = recentchanges.feed_key(request, etag)
+            payload = cache.get(key)
+            if payload is None:
+                response = super(ConditionalFeed, self).__call__(
+                    request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                payload = (response['Content-Type'], response.content)
+                cache.set(key, payload, recentchanges.FEED_CACHE_SECONDS)
+            return HttpResponse(payload[1], content_type=payload[0])
+
+        return condition(
+            etag_func=lambda request, *args, **kwargs: etag,
+            last_modified_func=lambda request, *args, **kwargs: last_modified
+        )(view)(request, *args, **kwargs)
 
     def item_title(self, item):
         return unicode(item)
 
     def item_description(self, item):
-        return unicode(item.body)
+        return recentchanges.describe(item)
 
     def item_link(self, item):
         return item.get_absolute_url()
 
+    def item_pubdate(self, item):
+        return item.timestamp
+
+
+class LatestEditsFeed(ConditionalFeed):
+    ''' changes to every article, the section, author and status GET
+        parameters filter the changes shown '''
+    title = 'Recent Changes'
+    link = '/'
+    description = 'Latest Changes to Wiki Articles'
+
+    def etag(self, request, last_modified):
+        # status changes, renames and removals create no version but do
+        # change the articles' modified time
+        latest = ArticleVersion.objects.order_by('-pk').values_list('pk',
+                                                                    flat=True)
+        for pk in latest[:1]:
+            return 'rc-%s-%s' % (pk, _stamp(last_modified))
+
+    def last_modified(self, request):
+        return Article.objects.aggregate(Max('modified'))['modified__max']
+
+    def get_object(self, request):
+        filters = {'section': request.GET.get('section'),
+                   'author': request.GET.get('author')}
+        status = request.GET.get('status')
+        if status:
+            if status not in STATUSES:
+                raise Http404('unknown status %s' % status)
+            filters['status'] = STATUSES[status]
+        return filters
+
+    def items(self, obj):
+        return recentchanges.get_changes(**obj)
+
+
+class LatestArticleEditsFeed(ConditionalFeed):
+
+    def etag(self, request, last_modified, title):
+        articles = Article.objects.filter(title_key=title_key(title))
+        for pk, number in articles.values_list('pk', 'latest_number'):
+            return 'rc-%s-%s-%s' % (pk, number, _stamp(last_modified))
 
-class LatestArticleEditsFeed(Feed):
+    def last_modified(self, request, title):
+        articles = Article.objects.filter(title_key=title_key(title))
+        for modified in articles.values_list('modified', flat=True):
+            return modified
 
     def get_object(self, request, title):
-        return get_object_or_404(Article, title=title)
+        return get_object_or_404(Article, title_key=title_key(title))
 
     def title(self, obj):
         return 'Recent changes to %s' % obj
@@ -35,13 +119,8 @@ class LatestArticleEditsFeed(Feed):
         return obj.get_absolute_url()
 
     def items(self, obj):
-        return obj.versions.order_by('-timestamp').select_related()[:20]
+        return recentchanges.get_changes(article=obj)
 
-    def item_title(self, item):
-        return unicode(item)
-
-    def item_description(self, item):
-        return unicode(item.body)
-
-    def item_link(self, item):
-        return item.get_absolute_url()
+# instances for the urlconf to load on first request
+latest_edits = LatestEditsFeed()
+latest_article_edits = LatestArticleEditsFeed()
@@ -5,6 +5,11 @@ from markupwiki.models import Article, ArticleVersion
 MARKUP_TYPE_EDITABLE = getattr(settings, 'MARKUPWIKI_MARKUP_TYPE_EDITABLE', True)
 
 class ArticleForm(forms.ModelForm):
+    # number of the version the edit was based on (for optimistic edits)
+    base_revision = forms.IntegerField(required=False, widget=forms.HiddenInput)
+    # number of the section being edited (see markupwiki.sections)
+    section = forms.IntegerField(required=False, widget=forms.HiddenInput)
+
     class Meta:
         model = ArticleVersion
         fields = ['body', 'comment']
@@ -0,0 +1,205 @@
+'''
+    optional timing of markupwiki's views
+
+    With MARKUPWIKI_INSTRUMENTATION = True and
+    ``markupwiki.instrumentation.InstrumentationMiddleware`` in
+    MIDDLEWARE_CLASSES every request to a markupwiki view or feed records:
+
+    sql       - number of queries and time spent in the database
+    markup    - time spent in markup functions (markdown, ReST, ...)
+    links     - time spent turning [[links]] into html
+    diff      - time spent building diffs
+    template  - time spent rendering templates
+    total     - time spent in the view
+
+    Phases can nest (links happen during markup) so they don't add up to the
+    total.  Functions run by ``markupwiki.workers`` add to the timings of the
+    request that started them.  The timings are added to the response as a
+    Server-Timing header and passed to each sink in
+    MARKUPWIKI_INSTRUMENTATION_SINKS.
+
+    When instrumentation is disabled ``timed`` returns functions unchanged so
+    there is no overhead.
+'''
+
+import collections
+import logging
+import socket
+import threading
+import time
+from django.conf import settings
+from django.db import connections
+from django.utils.functional import wraps
+from django.utils.importlib import import_module
+
+ENABLED = getattr(settings, 'MARKUPWIKI_INSTRUMENTATION', False)
+SINKS = getattr(settings, 'MARKUPWIKI_INSTRUMENTATION_SINKS',
+                ('markupwiki.instrumentation.LoggingSink',))
+STATSD_ADDRESS = getattr(settings, 'MARKUPWIKI_STATSD_ADDRESS',
+                         ('127.0.0.1', 8125))
+STATSD_PREFIX = getattr(settings, 'MARKUPWIKI_STATSD_PREFIX', 'markupwiki')
+RING_BUFFER_SIZE = getattr(settings, 'MARKUPWIKI_RING_BUFFER_SIZE', 1000)
+
+_local = threading.local()
+
+
+class RequestTimings(object):
+    ''' timings recorded while handling a single request '''
+
+    def __init__(self, view_name):
+        self.view_name = view_name
+        self.phases = collections.defaultdict(float)
+        self.queries = 0
+        # worker threads add to the timings too
+        self.lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] += seconds
+
+    def server_timing(self):
+        ''' value for the Server-Timing header '''
+        entries = []
+        for phase, seconds in sorted(self.phases.items()):
+            entry = '%s;dur=%.2f' % (phase, seconds * 1000)
+            if phase == 'sql':
+                entry += ';desc="%s queries"' % self.queries
+            entries.append(entry)
+        return ', '.join(entries)
+
+
+def get_timings():
+    ''' return the RequestTimings being recorded in this thread (or None) '''
+    return getattr(_local, 'timings', None)
+
+def set_timings(timings):
+    ''' record timed functions run in this thread in timings (None stops) '''
+    _local.timings = timings
+
+
+def timed(phase):
+    ''' decorator that adds the time spent in a function to phase '''
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        def new_func(*args, **kwargs):
+            timings = getattr(_local, 'timings', None)
+            if timings is None:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.add(phase, time.time() - start)
+        return wraps(func)(new_func)
+    return decorator
+
+
+class LoggingSink(object):
+    ''' logs timings to the markupwiki.instrumentation logger '''
+
+    logger = logging.getLogger('markupwiki.instrumentation')
+
+    def emit(self, timings):
+        self.logger.info('%s %s', timings.view_name, timings.server_timing())
+
+
+class StatsdSink(object):
+    ''' sends timings to a StatsD compatible collector over UDP '''
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def emit(self, timings):
+        prefix = '%s.%s' % (STATSD_PREFIX, timings.view_name)
+        lines = ['%s.%s:%.3f|ms' % (prefix, phase, seconds * 1000)
+                 for phase, seconds in timings.phases.items()]
+        lines.append('%s.queries:%s|c' % (prefix, timings.queries))
+        try:
+            self.socket.sendto('\n'.join(lines).encode('ascii'),
+                               STATSD_ADDRESS)
+        except socket.error:
+            pass
+
+
+class RingBufferSink(object):
+    ''' keeps the timings of the last MARKUPWIKI_RING_BUFFER_SIZE requests in
+        RingBufferSink.records '''
+
+    records = collections.deque(maxlen=RING_BUFFER_SIZE)
+
+    def emit(self, timings):
+        self.records.append((timings.view_name, dict(timings.phases),
+                             timings.queries))
+
+
+_sinks = None
+
+def get_sinks():
+    global _sinks
+    if _sinks is None:
+        _sinks = []
+        for path in SINKS:
+            module, cls = path.rsplit('.', 1)
+            _sinks.append(getattr(import_module(module), cls)())
+    return _sinks
+
+
+class InstrumentationMiddleware(object):
+    ''' records timings for requests handled by markupwiki views '''
+
+    def process_request(self, request):
+        # nothing from an earlier request may be left over
+        _local.timings = None
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not ENABLED:
+            return None
+        # feeds are callable instances so check the class's module too
+        module = getattr(view_func, '__module__', None) or \
+                 type(view_func).__module__
+        if not module.startswith('markupwiki.'):
+            return None
+        name = getattr(view_func, '__name__', type(view_func).__name__)
+        _local.timings = RequestTimings(name)
+        _local.start = time.time()
+        _local.debug_cursors = []
+        _local.queries = []
+        for connection in connections.all():
+            _local.debug_cursors.append(connection.use_debug_cursor)
+            connection.use_debug_cursor = True
+            _local.queries.append(len(connection.queries))
+        return None
+
+    def _finish(self):
+        ''' stop recording and return the timings (None if not recording) '''
+        timings = getattr(_local, 'timings', None)
+        if timings is None:
+            return None
+        _local.timings = None
+
+        timings.add('total', time.time() - _local.start)
+        for connection, debug_cursor, before in zip(connections.all(),
+                                                    _local.debug_cursors,
+                                                    _local.queries):
+            queries = connection.queries[before:]
+            timings.queries += len(queries)
+            timings.add('sql', sum(float(q['time']) for q in queries))
+            connection.use_debug_cursor = debug_cursor
+        return timings
+
+    def process_exception(self, request, exception):
+        # the response for the exception isn't the view's, so is not timed
+        self._finish()
+        return None
+
+    def process_response(self, request, response):
+        timings = self._finish()
+        if timings is None:
+            return response
+        response['Server-Timing'] = timings.server_timing()
+        for sink in get_sinks():
+            sink.emit(timings)
+        return response
@@ -1,22 +1,77 @@
+from optparse import make_option
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-from django.db.models import Min
 from markupwiki.models import Article, PUBLIC, LOCKED, DELETED
+from markupwiki import rendercache
 import datetime
 
 class Command(BaseCommand):
     help = 'Auto-locks articles based on time and other factors'
 
-    def handle(self, *args, **options):
-        ''' Lock any public article that was created earlier than
-            MARKUPWIKI_AUTOLOCK_TIMEDELTA ago.
-        '''
-        
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='only report how many articles would be locked'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=500, help='number of articles to lock at a time'),
+    )
+
+    def get_policies(self):
+        ''' return (name, filter) pairs for each configured policy '''
+        now = datetime.datetime.now()
+        policies = []
+
         timedelta = getattr(settings, 'MARKUPWIKI_AUTOLOCK_TIMEDELTA', None)
-        
         if timedelta is not None:
-            
-            ts = datetime.datetime.now() - timedelta
-            qs = Article.objects.filter(status=PUBLIC).annotate(
-                    timestamp=Min('versions__timestamp')).filter(timestamp__lte=ts)
-            qs.update(status=LOCKED)
+            policies.append(('age', {'created__lte': now - timedelta}))
+
+        edit_count = getattr(settings, 'MARKUPWIKI_AUTOLOCK_EDIT_COUNT', None)
+        if edit_count is not None:
+            # versions are numbered from 0, so this counts every edit ever
+            # made even if compactwiki has deleted some of the versions
+            policies.append(('edits', {'latest_number__gte': edit_count - 1}))
+
+        inactivity = getattr(settings, 'MARKUPWIKI_AUTOLOCK_INACTIVITY', None)
+        if inactivity is not None:
+            policies.append(('inactivity',
+                             {'modified__lte': now - inactivity}))
+
+        return policies
+
+    def handle(self, *args, **options):
+        ''' Lock public articles matching any of the configured policies:
+
+            age         - created earlier than MARKUPWIKI_AUTOLOCK_TIMEDELTA ago
+            edits       - at least MARKUPWIKI_AUTOLOCK_EDIT_COUNT edits made,
+                          including versions since deleted
+            inactivity  - not edited for MARKUPWIKI_AUTOLOCK_INACTIVITY
+
+            Each policy is a single filter on Article and articles are locked
+            in batches of --batch-size.  Locking updates the articles'
+            modified time so the feeds change.
+        '''
+        batch_size = options['batch_size']
+        articles = Article.objects.filter(status=PUBLIC, latest_number__gte=0)
+
+        for name, filters in self.get_policies():
+            matching = articles.filter(**filters)
+            if options['dry_run']:
+                self.stdout.write('%s: %s articles would be locked\n' %
+                                  (name, matching.count()))
+                continue
+
+            locked = 0
+            last_pk = 0
+            while True:
+                batch = list(matching.filter(pk__gt=last_pk).order_by('pk')
+                             .values_list('pk', 'title')[:batch_size])
+                if not batch:
+                    break
+                Article.objects.filter(pk__in=[pk for pk, title in batch],
+                                       status=PUBLIC).update(
+                    status=LOCKED, modified=datetime.datetime.now())
+                for pk, title in batch:
+                    rendercache.invalidate_title(title)
+                locked += len(batch)
+                last_pk = batch[-1][0]
+                self.stdout.write('%s: locked %s articles\n' % (name, locked))
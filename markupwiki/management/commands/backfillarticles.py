@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from markupwiki.models import Article
+from markupwiki.utils import title_section, title_key
+
+class Command(BaseCommand):
+    help = 'Populates denormalized Article fields from existing versions'
+
+    def handle(self, *args, **options):
+        ''' Set current_version, latest_number, title_key, section and
+            created (from the first version) on every article.
+
+            An article whose title_key is already taken (titles that only
+            differ in case or spacing) is renamed by adding _2, _3, ... to
+            its title, each rename is listed.
+
+            Needs to be run once after upgrading from a version of markupwiki
+            that didn't maintain these fields.
+        '''
+
+        last_pk = 0
+        while True:
+            articles = list(Article.objects.filter(pk__gt=last_pk)
+                            .order_by('pk')[:500])
+            if not articles:
+                break
+            for article in articles:
+                article.update_current_version()
+                fields = {'section': title_section(article.title)}
+                for created in article.versions.order_by('number').values_list(
+                        'timestamp', flat=True)[:1]:
+                    fields['created'] = created
+                title = article.title
+                n = 1
+                while Article.objects.filter(title_key=title_key(title)) \
+                                     .exclude(pk=article.pk).exists():
+                    n += 1
+                    title = '%s_%s' % (article.title, n)
+                if title != article.title:
+                    self.stdout.write('renamed %s to %s, its title clashed '
+                                      'with another\n' % (article.title, title))
+                    fields['title'] = title
+                fields['title_key'] = title_key(title)
+                Article.objects.filter(pk=article.pk).update(**fields)
+            last_pk = articles[-1].pk
@@ -0,0 +1,141 @@
+import datetime
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db.models import signals
+from markupwiki.models import (Article, ArticleVersion, atomic,
+                               _version_pre_delete)
+from markupwiki import storage
+
+def _size(version):
+    return sum(len((text or '').encode('utf8')) for text in
+               (version.body.raw, version._body_rendered, version.body_delta))
+
+class Command(BaseCommand):
+    help = 'Deletes old article versions according to retention policies'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--keep-last', type='int', dest='keep_last', default=None,
+                    help='always keep the newest N versions of an article, '
+                         'if given on its own every older version is '
+                         'deleted'),
+        make_option('--daily-after', type='int', dest='daily_after',
+                    default=None,
+                    help='only keep the newest version of each day for '
+                         'versions more than N days old'),
+        make_option('--squash-window', type='int', dest='squash_window',
+                    default=None,
+                    help='delete versions followed within N seconds by a '
+                         'version by the same author'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=100, help='number of articles to load at a time'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='only report what would be deleted'),
+    )
+
+    def handle(self, *args, **options):
+        ''' Delete article versions that aren't worth keeping.
+
+            A version is deleted if it isn't the latest version of its
+            article and either it has been marked removed, or it isn't one of
+            the --keep-last newest versions and --daily-after, --squash-window
+            or --keep-last on its own say it can go.
+
+            Each article is compacted in its own transaction and the latest
+            version is never touched, so edits can carry on meanwhile.
+            Delta stored versions whose next version is deleted are
+            re-encoded against the next version that's kept.
+        '''
+        self.keep_last = options['keep_last']
+        self.squash_window = None
+        if options['squash_window'] is not None:
+            self.squash_window = datetime.timedelta(
+                seconds=options['squash_window'])
+        self.daily_cutoff = None
+        if options['daily_after'] is not None:
+            self.daily_cutoff = datetime.datetime.now() - datetime.timedelta(
+                days=options['daily_after'])
+
+        deleted = rewritten = reclaimed = 0
+        last_pk = 0
+        while True:
+            articles = list(Article.objects.filter(pk__gt=last_pk)
+                            .order_by('pk').only('pk', 'title')
+                            [:options['batch_size']])
+            if not articles:
+                break
+            for article in articles:
+                deletes, rewrites, size = self.plan(article)
+                if not options['dry_run'] and (deletes or rewrites):
+                    self.compact(deletes, rewrites)
+                deleted += len(deletes)
+                rewritten += len(rewrites)
+                reclaimed += size
+            last_pk = articles[-1].pk
+            self.stdout.write('%s versions deleted, %s bytes reclaimed '
+                              '(up to article %s)\n' % (deleted, reclaimed,
+                                                        last_pk))
+
+        self.stdout.write('%s%s versions deleted, %s deltas re-encoded, '
+                          '%s bytes reclaimed\n' % (
+                              'dry run: ' if options['dry_run'] else '',
+                              deleted, rewritten, reclaimed))
+
+    def is_deletable(self, index, version, newer):
+        ''' index is the position of version counting from the latest
+            version, newer is the version just after it '''
+        if index == 0:
+            return False
+        if version.removed:
+            return True
+        if self.keep_last is not None and index < self.keep_last:
+            return False
+        if self.squash_window is not None and version.author_id and \
+                version.author_id == newer.author_id and \
+                newer.timestamp - version.timestamp <= self.squash_window:
+            return True
+        if self.daily_cutoff is not None:
+            return (version.timestamp < self.daily_cutoff and
+                    version.timestamp.date() == newer.timestamp.date())
+        # --keep-last on its own deletes everything older
+        return self.keep_last is not None and self.squash_window is None
+
+    def plan(self, article):
+        ''' return (pks to delete, {pk: new delta}, bytes reclaimed) '''
+        deletes = []
+        rewrites = {}
+        reclaimed = 0
+        newer = None
+        kept_raw = None
+        newer_deleted = False
+        for index, (version, raw) in enumerate(
+                storage.iter_raw_bodies(article)):
+            if self.is_deletable(index, version, newer):
+                deletes.append(version.pk)
+                reclaimed += _size(version)
+                newer_deleted = True
+            else:
+                # the delta was against a version that's being deleted
+                if version.body_delta and newer_deleted:
+                    delta = storage.encode_delta(kept_raw, raw)
+                    rewrites[version.pk] = delta
+                    reclaimed += len(version.body_delta) - len(delta)
+                kept_raw = raw
+                newer_deleted = False
+            newer = version
+        return deletes, rewrites, reclaimed
+
+    def compact(self, deletes, rewrites):
+        # the deltas have already been re-encoded, the pre_delete handler
+        # would turn the ones based on these versions back into full copies
+        signals.pre_delete.disconnect(_version_pre_delete,
+                                      sender=ArticleVersion)
+        try:
+            with atomic():
+                for pk, delta in rewrites.items():
+                    ArticleVersion.objects.filter(pk=pk).update(
+                        body_delta=delta)
+                ArticleVersion.objects.filter(pk__in=deletes).delete()
+        finally:
+            signals.pre_delete.connect(_version_pre_delete,
+                                       sender=ArticleVersion)
@@ -0,0 +1,52 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from markupwiki.models import Article, ArticleVersion
+from markupwiki import storage
+
+class Command(BaseCommand):
+    help = 'Converts stored article versions to (or from) delta storage'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--decompress', action='store_true', dest='decompress',
+                    default=False,
+                    help='store every version as a full copy again'),
+    )
+
+    def handle(self, *args, **options):
+        ''' Rewrite every article's history so that versions other than the
+            head and snapshots are stored as deltas (or, with --decompress,
+            so that every version is a full copy).
+
+            Rendered html of delta stored versions is dropped and re-rendered
+            when the version is next viewed.
+        '''
+        decompress = options['decompress']
+
+        last_pk = 0
+        saved = 0
+        while True:
+            articles = list(Article.objects.filter(pk__gt=last_pk)
+                            .order_by('pk')[:100])
+            if not articles:
+                break
+
+            for article in articles:
+                newer_raw = None
+                for version, raw in storage.iter_raw_bodies(article):
+                    qs = ArticleVersion.objects.filter(pk=version.pk)
+                    if decompress or newer_raw is None or \
+                       storage.is_snapshot(version.number):
+                        if version.body_delta:
+                            qs.update(body=raw, body_delta='')
+                    elif not version.body_delta:
+                        delta = storage.encode_delta(newer_raw, raw)
+                        saved += (len(raw) + len(version._body_rendered) -
+                                  len(delta))
+                        qs.update(body='', _body_rendered='', body_delta=delta)
+                    newer_raw = raw
+
+            last_pk = articles[-1].pk
+            self.stdout.write('processed articles up to %s\n' % last_pk)
+
+        if not decompress:
+            self.stdout.write('%s bytes saved\n' % saved)
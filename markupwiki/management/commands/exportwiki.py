@@ -0,0 +1,68 @@
+import gzip
+import json
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from markupwiki.models import Article
+from markupwiki import storage
+
+class Command(BaseCommand):
+    args = '<filename>'
+    help = 'Exports every article and its full history as JSON lines'
+
+    def handle(self, *args, **options):
+        ''' Write one JSON object per line: an "article" record followed by
+            a "version" record for each of its versions, newest first.
+
+            Filenames ending in .gz are gzipped, "-" writes to stdout.
+            Articles are read in chunks and versions are streamed so memory
+            use doesn't depend on the size of the wiki.
+        '''
+        if len(args) != 1:
+            raise CommandError('exportwiki takes a single filename')
+
+        filename = args[0]
+        if filename == '-':
+            out = getattr(sys.stdout, 'buffer', sys.stdout)
+        elif filename.endswith('.gz'):
+            out = gzip.open(filename, 'wb')
+        else:
+            out = open(filename, 'wb')
+
+        try:
+            last_pk = 0
+            count = 0
+            while True:
+                articles = list(Article.objects.filter(pk__gt=last_pk)
+                                .select_related('creator', 'redirect_to')
+                                .order_by('pk')[:100])
+                if not articles:
+                    break
+                for article in articles:
+                    self._write(out, {
+                        'type': 'article',
+                        'title': article.title,
+                        'status': article.status,
+                        'creator': article.creator.username if article.creator else None,
+                        'redirect_to': article.redirect_to.title if article.redirect_to else None,
+                    })
+                    for version, raw in storage.iter_raw_bodies(article):
+                        self._write(out, {
+                            'type': 'version',
+                            'number': version.number,
+                            'author': version.author.username if version.author else None,
+                            'timestamp': version.timestamp.isoformat(),
+                            'comment': version.comment,
+                            'removed': version.removed,
+                            'markup_type': version.body_markup_type,
+                            'body': raw,
+                        })
+                count += len(articles)
+                last_pk = articles[-1].pk
+                if filename != '-':
+                    self.stdout.write('exported %s articles\n' % count)
+        finally:
+            if filename != '-':
+                out.close()
+
+    def _write(self, out, record):
+        out.write((json.dumps(record) + '\n').encode('ascii'))
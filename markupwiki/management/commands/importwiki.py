@@ -0,0 +1,166 @@
+import gzip
+import json
+import sys
+from optparse import make_option
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models
+from django.db.models import F
+from django.utils.dateparse import parse_datetime
+from markupwiki.models import Article, ArticleVersion, render_markup, atomic
+from markupwiki.utils import title_section, title_key
+
+def _insert_versions(versions):
+    ''' insert versions with their columns stored as given, bulk_create would
+        render every body and set the timestamps to now '''
+    fields = [f for f in ArticleVersion._meta.local_fields
+              if not isinstance(f, models.AutoField)]
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(ArticleVersion._meta.db_table),
+        ', '.join(qn(f.column) for f in fields),
+        ', '.join(['%s'] * len(fields)))
+    rows = [[f.get_db_prep_save(getattr(version, f.attname),
+                                connection=connection) for f in fields]
+            for version in versions]
+    connection.cursor().executemany(sql, rows)
+
+
+class Command(BaseCommand):
+    args = '<filename>'
+    help = 'Imports articles written by exportwiki'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000,
+                    help='number of versions to insert at a time'),
+    )
+
+    def handle(self, *args, **options):
+        ''' Read a file written by exportwiki and create its articles and
+            versions with bulk inserts, one transaction per batch.
+
+            Only the newest version of each article is rendered, older
+            versions are rendered when they are first viewed.  Articles
+            whose title already exists are skipped.  Run rebuildlinks and
+            rebuildsearchindex afterwards.
+        '''
+        if len(args) != 1:
+            raise CommandError('importwiki takes a single filename')
+
+        filename = args[0]
+        if filename == '-':
+            infile = getattr(sys.stdin, 'buffer', sys.stdin)
+        elif filename.endswith('.gz'):
+            infile = gzip.open(filename, 'rb')
+        else:
+            infile = open(filename, 'rb')
+
+        self.batch_size = options['batch_size']
+        self.users = {}
+        self.redirects = []
+        self.skipped = 0
+        self.imported = 0
+        batch = []
+        versions = 0
+
+        try:
+            for line in infile:
+                record = json.loads(line.decode('utf8'))
+                if record['type'] == 'article':
+                    if versions >= self.batch_size:
+                        self._flush(batch)
+                        batch, versions = [], 0
+                    batch.append((record, []))
+                elif record['type'] == 'version':
+                    batch[-1][1].append(record)
+                    versions += 1
+            self._flush(batch)
+        finally:
+            if filename != '-':
+                infile.close()
+
+        # redirects can point forwards so they're done once everything exists
+        for title, target in self.redirects:
+            Article.objects.filter(title_key=title_key(title)).update(
+                redirect_to=Article.objects.get(title_key=title_key(target)))
+
+        self.stdout.write('imported %s articles, skipped %s existing\n' %
+                          (self.imported, self.skipped))
+
+    def _user(self, username):
+        if username is None:
+            return None
+        if username not in self.users:
+            pks = list(User.objects.filter(username=username).values_list(
+                'pk', flat=True)[:1])
+            self.users[username] = pks[0] if pks else None
+        return self.users[username]
+
+    def _flush(self, batch):
+        # titles that differ only in case or spacing count as existing
+        keys = set(Article.objects.filter(
+            title_key__in=[title_key(a['title']) for a, v in batch]
+        ).values_list('title_key', flat=True))
+        new_batch = []
+        for record, versions in batch:
+            key = title_key(record['title'])
+            if key in keys:
+                self.skipped += 1
+            else:
+                keys.add(key)
+                new_batch.append((record, versions))
+        batch = new_batch
+        if not batch:
+            return
+
+        with atomic():
+            articles = []
+            for record, versions in batch:
+                latest = max([v['number'] for v in versions] or [-1])
+                article = Article(title=record['title'],
+                                  title_key=title_key(record['title']),
+                                  status=record['status'],
+                                  creator_id=self._user(record['creator']),
+                                  latest_number=latest,
+                                  section=title_section(record['title']))
+                if versions:
+                    article.created = parse_datetime(min(
+                        versions, key=lambda v: v['number'])['timestamp'])
+                articles.append(article)
+                if record['redirect_to']:
+                    self.redirects.append((record['title'],
+                                           record['redirect_to']))
+            Article.objects.bulk_create(articles)
+            ids = dict(Article.objects.filter(
+                title_key__in=[a.title_key for a in articles]).values_list(
+                    'title_key', 'pk'))
+
+            new_versions = []
+            for record, versions in batch:
+                article_id = ids[title_key(record['title'])]
+                latest = max([v['number'] for v in versions] or [-1])
+                for v in versions:
+                    version = ArticleVersion(
+                        article_id=article_id, number=v['number'],
+                        author_id=self._user(v['author']),
+                        comment=v['comment'], removed=v['removed'],
+                        timestamp=parse_datetime(v['timestamp']),
+                        body_markup_type=v['markup_type'])
+                    version.body = v['body']
+                    version._body_rendered = (
+                        render_markup(v['body'], v['markup_type'])
+                        if v['number'] == latest else '')
+                    new_versions.append(version)
+            _insert_versions(new_versions)
+
+            heads = ArticleVersion.objects.filter(
+                article__in=ids.values(),
+                number=F('article__latest_number')).values_list(
+                    'article', 'pk', 'timestamp')
+            for article_id, version_id, timestamp in heads:
+                Article.objects.filter(pk=article_id).update(
+                    current_version=version_id, modified=timestamp)
+
+        self.imported += len(batch)
+        self.stdout.write('imported %s articles\n' % self.imported)
@@ -0,0 +1,44 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from markupwiki.models import Article, ArticleLink
+from markupwiki.utils import extract_links, title_key
+
+class Command(BaseCommand):
+    help = 'Rebuilds the index of links between articles'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=500, help='number of articles to load at a time'),
+    )
+
+    def handle(self, *args, **options):
+        ''' Recreate ArticleLink rows from the head version of every article.
+
+            Articles are processed in chunks so memory use doesn't depend on
+            the size of the wiki.
+        '''
+        chunk_size = options['chunk_size']
+
+        last_pk = 0
+        total = 0
+        while True:
+            rows = list(Article.objects.filter(pk__gt=last_pk)
+                        .order_by('pk')
+                        .values_list('pk', 'current_version__body')[:chunk_size])
+            if not rows:
+                break
+
+            pks = [pk for pk, body in rows]
+            ArticleLink.objects.filter(source__in=pks).delete()
+            links = []
+            for pk, body in rows:
+                keys = set(title_key(title)
+                           for title in extract_links(body or ''))
+                for key in keys:
+                    links.append(ArticleLink(source_id=pk, target_title=key))
+            ArticleLink.objects.bulk_create(links)
+
+            total += len(links)
+            last_pk = pks[-1]
+            self.stdout.write('%s links indexed (up to article %s)\n' %
+                              (total, last_pk))
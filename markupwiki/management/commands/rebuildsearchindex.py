@@ -0,0 +1,32 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from markupwiki.models import Article
+from markupwiki import search
+
+class Command(BaseCommand):
+    help = 'Rebuilds the article search index'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=500, help='number of articles to load at a time'),
+    )
+
+    def handle(self, *args, **options):
+        ''' Clear the search index and index the head version of every
+            article, a chunk at a time.
+        '''
+        chunk_size = options['chunk_size']
+        backend = search.get_backend()
+        backend.clear()
+
+        last_pk = 0
+        while True:
+            articles = list(Article.objects.filter(pk__gt=last_pk)
+                            .select_related('current_version')
+                            .order_by('pk')[:chunk_size])
+            if not articles:
+                break
+            for article in articles:
+                search.update_index(article)
+            last_pk = articles[-1].pk
+            self.stdout.write('indexed articles up to %s\n' % last_pk)
@@ -0,0 +1,103 @@
+import multiprocessing
+import os
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connection
+from markupwiki.models import Article, ArticleVersion, render_markup, atomic
+from markupwiki import rendercache, sections
+
+def _init_worker():
+    # sections cached before the settings changed would be reused otherwise
+    sections.SECTION_MARKUP_TYPES = ()
+
+def _render(row):
+    pk, raw, markup_type = row
+    return pk, render_markup(raw, markup_type)
+
+class Command(BaseCommand):
+    help = 'Re-renders the stored html of article versions'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=500, help='number of versions to load at a time'),
+        make_option('--processes', type='int', dest='processes',
+                    default=None,
+                    help='number of rendering processes (default: one per CPU)'),
+        make_option('--head-only', action='store_true', dest='head_only',
+                    default=False,
+                    help='only re-render the latest version of each article'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='file used to record progress, an interrupted run '
+                         'started with the same file carries on where it '
+                         'left off'),
+    )
+
+    def handle(self, *args, **options):
+        ''' Render the body of every version again with the current markup
+            settings, eg. after changing MARKUPWIKI_ESCAPE_HTML or
+            MARKUPWIKI_MARKUP_TYPES.
+
+            Versions are read in chunks ordered by primary key, rendered in a
+            multiprocessing pool and written back one transaction per chunk.
+            Versions stored as deltas aren't touched since they are rendered
+            when viewed.
+        '''
+        chunk_size = options['chunk_size']
+        checkpoint = options['checkpoint']
+
+        last_pk = 0
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                last_pk = int(f.read().strip() or 0)
+            self.stdout.write('resuming after version %s\n' % last_pk)
+
+        versions = ArticleVersion.objects.filter(body_delta='')
+        if options['head_only']:
+            versions = versions.filter(
+                pk__in=Article.objects.values('current_version'))
+
+        # don't share the database connection with the forked workers
+        connection.close()
+        pool = multiprocessing.Pool(options['processes'], _init_worker)
+        count = 0
+        try:
+            while True:
+                rows = list(versions.filter(pk__gt=last_pk).order_by('pk')
+                            .values_list('pk', 'body', 'body_markup_type')
+                            [:chunk_size])
+                if not rows:
+                    break
+
+                rendered = pool.map(_render, rows)
+                with atomic():
+                    for pk, html in rendered:
+                        ArticleVersion.objects.filter(pk=pk).update(
+                            _body_rendered=html)
+
+                self._invalidate(rows)
+                count += len(rows)
+                last_pk = rows[-1][0]
+                if checkpoint:
+                    with open(checkpoint, 'w') as f:
+                        f.write(str(last_pk))
+                self.stdout.write('re-rendered %s versions (up to %s)\n' %
+                                  (count, last_pk))
+        finally:
+            pool.close()
+            pool.join()
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+    def _invalidate(self, rows):
+        pks = [pk for pk, body, markup_type in rows]
+        cache = rendercache.get_render_cache()
+        cache.delete_many([rendercache.rendered_key(pk, timestamp,
+                                                    markup_type)
+                           for pk, timestamp, markup_type in
+                           ArticleVersion.objects.filter(pk__in=pks)
+                           .values_list('pk', 'timestamp',
+                                        'body_markup_type')])
+        for title in Article.objects.filter(current_version__in=pks) \
+                                    .values_list('title', flat=True):
+            rendercache.invalidate_title(title)
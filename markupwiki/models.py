@@ -1,29 +1,43 @@
 import datetime
 from django.db import models
+try:
+    from django.db.transaction import atomic
+except ImportError:     # Django < 1.6
+    from django.db.transaction import commit_on_success as atomic
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
+from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
+from django.utils.html import escape
 from markupfield.fields import MarkupField
-from markupfield import markup
-from markupwiki.utils import wikify_markup_wrapper
+from markupwiki.utils import extract_links, title_section, title_key
+from markupwiki import rendercache, search, storage, recentchanges
+from markupwiki.conf import conf, lazy_markup_func
 
-DEFAULT_MARKUP_TYPE = getattr(settings, 'MARKUPWIKI_DEFAULT_MARKUP_TYPE',
-                              'markdown')
 WRITE_LOCK_SECONDS = getattr(settings, 'MARKUPWIKI_WRITE_LOCK_SECONDS', 300)
-MARKUP_TYPES = getattr(settings, 'MARKUPWIKI_MARKUP_TYPES',
-                       markup.DEFAULT_MARKUP_TYPES)
-ESCAPE_HTML = getattr(settings, 'MARKUPWIKI_ESCAPE_HTML',
-                      True)
-EDITOR_TEST_FUNC = getattr(settings, 'MARKUPWIKI_EDITOR_TEST_FUNC',
-                           lambda u: u.is_authenticated())
-MODERATOR_TEST_FUNC = getattr(settings, 'MARKUPWIKI_MODERATOR_TEST_FUNC',
-                              lambda u: u.is_staff)
-
-# add make_wiki_links to MARKUP_TYPES
-WIKI_MARKUP_TYPES = []
-for name, func in MARKUP_TYPES:
-    WIKI_MARKUP_TYPES.append((name, wikify_markup_wrapper(func)))
+DEFAULT_MARKUP_TYPE = conf.DEFAULT_MARKUP_TYPE
+
+# markupfield needs the functions now, they're built on first render
+WIKI_MARKUP_TYPES = [(name, lazy_markup_func(name))
+                     for name in conf.markup_names]
+
+def render_markup(raw, markup_type, wiki_links=True):
+    ''' render raw text the same way ArticleVersion.body would be rendered,
+        with wiki_links=False [[links]] are left for make_wiki_links '''
+    if conf.ESCAPE_HTML:
+        raw = escape(raw)
+    return conf.get_markup_func(markup_type, wiki_links)(raw)
+
+class EditConflict(Exception):
+    ''' raised by Article.add_version when the article has a newer version
+        than the one an edit was based on '''
+    def __init__(self, head):
+        super(EditConflict, self).__init__('article has been edited since')
+        self.head = head
+
+class RedirectLoop(Exception):
+    ''' raised when saving an article whose redirect would lead back to it '''
 
 PUBLIC, LOCKED, DELETED = range(3)
 ARTICLE_STATUSES = (
@@ -34,10 +48,28 @@ ARTICLE_STATUSES = (
 
 class Article(models.Model):
     title = models.CharField(max_length=200)
+    # normalized title used for lookups, see utils.title_key
+    title_key = models.CharField(max_length=200, unique=True, null=True,
+                                 editable=False)
     creator = models.ForeignKey(User, related_name='wiki_articles', blank=True, null=True)
     status = models.IntegerField(choices=ARTICLE_STATUSES, default=PUBLIC)
     redirect_to = models.ForeignKey('self', blank=True, null=True)
 
+    # denormalized pointer to the head revision, maintained by ArticleVersion
+    current_version = models.ForeignKey('ArticleVersion', related_name='+',
+                                        blank=True, null=True,
+                                        on_delete=models.SET_NULL,
+                                        editable=False)
+    latest_number = models.IntegerField(default=-1, editable=False)
+    # last time the article or one of its versions changed
+    modified = models.DateTimeField(auto_now=True, null=True, db_index=True)
+    created = models.DateTimeField(default=datetime.datetime.now, null=True,
+                                   db_index=True, editable=False)
+    # title key of the section the article is in ('' at the top level), set
+    # from the title on save
+    section = models.CharField(max_length=200, blank=True, editable=False,
+                               db_index=True)
+
     def __unicode__(self):
         return self.title
 
@@ -55,9 +87,109 @@ class Article(models.Model):
     #         self.creator = None
     #     super(Article, self).save(**kwargs)
 
+    def save(self, **kwargs):
+        with atomic():
+            if self.pk:
+                self._refresh_head()
+            if self.redirect_to_id:
+                target_id = self.get_redirect_target_id()
+                if target_id != self.redirect_to_id:
+                    self.redirect_to = Article.objects.get(pk=target_id)
+            self.title_key = title_key(self.title)
+            self.section = title_section(self.title)
+            super(Article, self).save(**kwargs)
+        rendercache.invalidate_title(self.title)
+        search.update_index(self)
+
+        # cached redirects to this article hold its title, and redirects to
+        # an article that now redirects itself are pointed past it
+        redirects = Article.objects.filter(redirect_to=self)
+        titles = list(redirects.values_list('title', flat=True))
+        if titles and self.redirect_to_id:
+            redirects.update(redirect_to=self.redirect_to_id)
+        for title in titles:
+            rendercache.invalidate_title(title)
+
+    def _refresh_head(self):
+        ''' lock the row and take current_version and latest_number from it,
+            they're maintained by ArticleVersion and a stale copy (eg. in the
+            admin) mustn't be written back over a concurrent edit '''
+        rows = Article.objects.select_for_update().filter(pk=self.pk)
+        for old_title, current_id, latest in rows.values_list(
+                'title', 'current_version', 'latest_number'):
+            # status changes and renames invalidate the cached head entries
+            rendercache.invalidate_title(old_title)
+            if current_id != self.current_version_id:
+                self.current_version = (ArticleVersion.objects.get(
+                    pk=current_id) if current_id else None)
+            self.latest_number = latest
+
+    def clean(self):
+        if self.redirect_to_id:
+            try:
+                self.get_redirect_target_id()
+            except (RedirectLoop, Article.DoesNotExist) as e:
+                raise ValidationError(unicode(e))
+
+    def get_redirect_target_id(self):
+        ''' return the pk of the article at the end of this article's chain of
+            redirects, raises RedirectLoop if the chain leads back here and
+            Article.DoesNotExist if an article in it has been deleted '''
+        seen = set([self.pk])
+        target_id = self.redirect_to_id
+        while True:
+            if target_id in seen:
+                raise RedirectLoop('%s redirects to itself' % self.title)
+            seen.add(target_id)
+            next_ids = list(Article.objects.filter(pk=target_id).values_list(
+                'redirect_to', flat=True))
+            if not next_ids:
+                raise Article.DoesNotExist('%s redirects to a deleted article'
+                                           % self.title)
+            if next_ids[0] is None:
+                return target_id
+            target_id = next_ids[0]
+
     def get_absolute_url(self):
         return reverse('view_article', args=[self.title])
 
+    def get_latest_version(self):
+        ''' return the head ``ArticleVersion`` (falls back to a query if the
+            denormalized pointer hasn't been populated yet) '''
+        if self.current_version_id:
+            return self.current_version
+        return self.versions.latest()
+
+    def get_backlinks(self):
+        ''' return a queryset of the articles that link to this article '''
+        return Article.objects.filter(
+            links__target_title=title_key(self.title)).distinct()
+
+    def update_links(self, text):
+        ''' update this article's outgoing links to match text '''
+        new_titles = set(title_key(title) for title in extract_links(text))
+        old_titles = set(self.links.values_list('target_title', flat=True))
+        removed = old_titles - new_titles
+        if removed:
+            self.links.filter(target_title__in=removed).delete()
+        ArticleLink.objects.bulk_create(
+            [ArticleLink(source=self, target_title=title)
+             for title in new_titles - old_titles])
+
+    def update_current_version(self):
+        ''' recompute current_version/latest_number from the versions table '''
+        try:
+            head = self.versions.order_by('-number', '-timestamp')[0]
+        except IndexError:
+            head = None
+        self.current_version = head
+        self.latest_number = head.number if head else -1
+        self.modified = head.timestamp if head else datetime.datetime.now()
+        Article.objects.filter(pk=self.pk).update(
+            current_version=head, latest_number=self.latest_number,
+            modified=self.modified)
+        rendercache.invalidate_title(self.title)
+
     def is_public(self):
         return self.status == PUBLIC
 
@@ -69,25 +201,56 @@ class Article(models.Model):
 
     def is_editable_by_user(self, user):
         if self.status in (LOCKED, DELETED):
-            return MODERATOR_TEST_FUNC(user)
+            return conf.MODERATOR_TEST_FUNC(user)
         else:
-            return EDITOR_TEST_FUNC(user)
+            return conf.EDITOR_TEST_FUNC(user)
 
     def get_write_lock(self, user_or_request, release=False):
+        ''' acquire (or renew) the write lock for a user or session
+
+            returns True if the lock is held by user_or_request, with
+            release=True the lock is released if held and True is returned
+            unless someone else holds it
+        '''
         if hasattr(user_or_request, 'session'):
             lock_id = user_or_request.session.session_key
         else:
             lock_id = user_or_request.id
         cache_key = 'markupwiki_articlelock_%s' % self.id
-        lock = cache.get(cache_key)
-        if lock:
-            if release:
+
+        if release:
+            lock = cache.get(cache_key)
+            if lock == lock_id:
                 cache.delete(cache_key)
-            return lock == lock_id
+            return lock is None or lock == lock_id
 
-        if not release:
+        # cache.add only succeeds if nobody else holds the lock
+        if cache.add(cache_key, lock_id, WRITE_LOCK_SECONDS):
+            return True
+        if cache.get(cache_key) == lock_id:
             cache.set(cache_key, lock_id, WRITE_LOCK_SECONDS)
-        return True
+            return True
+        return False
+
+    def add_version(self, version, base_number=None):
+        ''' save version as the new head of this article
+
+            the version number is allocated while holding a row lock on the
+            article so concurrent edits can't be given the same number.  If
+            base_number is given and the article's head is no longer that
+            version EditConflict is raised instead.
+        '''
+        with atomic():
+            locked = Article.objects.select_for_update().get(pk=self.pk)
+            self.latest_number = locked.latest_number
+            if self.current_version_id != locked.current_version_id:
+                self.current_version = locked.current_version
+            if base_number is not None and base_number != locked.latest_number:
+                raise EditConflict(self.get_latest_version())
+            version.article = self
+            version.number = locked.latest_number + 1
+            version.save()
+        return version
 
 class ArticleVersion(models.Model):
     article = models.ForeignKey(Article, related_name='versions')
@@ -95,15 +258,22 @@ class ArticleVersion(models.Model):
     number = models.PositiveIntegerField()
     body = MarkupField(default_markup_type=DEFAULT_MARKUP_TYPE,
                        markup_choices=WIKI_MARKUP_TYPES,
-                       escape_html=ESCAPE_HTML)
+                       escape_html=conf.ESCAPE_HTML)
     comment = models.CharField(max_length=200, blank=True)
+    # compressed delta against the next version (see markupwiki.storage)
+    body_delta = models.TextField(blank=True, editable=False)
+
+    # lines changed from the previous version, shown in recent changes
+    lines_added = models.PositiveIntegerField(null=True, editable=False)
+    lines_removed = models.PositiveIntegerField(null=True, editable=False)
 
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
     removed = models.BooleanField(default=False)
 
     class Meta:
         ordering = ['timestamp']
         get_latest_by = 'timestamp'
+        unique_together = (('article', 'number'),)
 
     def __unicode__(self):
         return '%s rev #%s' % (self.article, self.number)
@@ -113,5 +283,115 @@ class ArticleVersion(models.Model):
     #         self.author = None
     #     super(ArticleVersion, self).save(**kwargs)
 
+    def restore_body(self):
+        ''' make sure body is populated for versions that are stored as a
+            delta or haven't been rendered, returns body '''
+        if self.body_delta and not getattr(self, '_body_restored', False):
+            self.body = storage.rebuild_raw(self)
+            self._body_rendered = ''
+            self._body_restored = True
+        if self.body.raw and not self._body_rendered:
+            self._body_rendered = render_markup(self.body.raw,
+                                                self.body_markup_type)
+        return self.body
+
+    def save(self, **kwargs):
+        is_new = self.pk is None
+        article = self.article
+        if is_new and self.number > article.latest_number and \
+                self.lines_added is None:
+            previous = ''
+            if article.current_version_id:
+                previous = ArticleVersion.objects.filter(
+                    pk=article.current_version_id).values_list(
+                        'body', flat=True)[0]
+            self.lines_added, self.lines_removed = \
+                recentchanges.count_changes(previous, self.body.raw)
+        if not is_new:
+            # the next older version may be a delta against the old text
+            stored = ArticleVersion.objects.filter(pk=self.pk).values_list(
+                'body', flat=True)
+            if list(stored) != [self.body.raw]:
+                _materialize_older(self)
+        super(ArticleVersion, self).save(**kwargs)
+        if is_new and self.number > article.latest_number:
+            previous_id = article.current_version_id
+            Article.objects.filter(pk=article.pk).update(
+                current_version=self, latest_number=self.number,
+                modified=self.timestamp)
+            article.current_version = self
+            article.latest_number = self.number
+            article.modified = self.timestamp
+            article.update_links(self.body.raw)
+            rendercache.invalidate_title(article.title)
+            search.update_index(article)
+            if previous_id and storage.REVISION_STORAGE == 'delta':
+                storage.compress_version(previous_id, self.body.raw)
+        elif not is_new and article.current_version_id == self.pk:
+            # head was edited in place (eg. through the admin)
+            article.current_version = self
+            article.modified = datetime.datetime.now()
+            Article.objects.filter(pk=article.pk).update(
+                modified=article.modified)
+            article.update_links(self.body.raw)
+            rendercache.invalidate_title(article.title)
+            search.update_index(article)
+        elif not is_new:
+            # eg. marked removed, which changes the feeds
+            Article.objects.filter(pk=article.pk).update(
+                modified=datetime.datetime.now())
+        if not is_new:
+            rendercache.invalidate_rendered(self)
+
     def get_absolute_url(self):
         return reverse('article_version', args=[self.article.title, self.number])
+
+class ArticleLink(models.Model):
+    ''' a [[link]] in the head version of source to the article whose
+        title_key is target_title '''
+    source = models.ForeignKey(Article, related_name='links')
+    target_title = models.CharField(max_length=200, db_index=True)
+
+    class Meta:
+        unique_together = (('source', 'target_title'),)
+
+    def __unicode__(self):
+        return '%s -> %s' % (self.source, self.target_title)
+
+class SearchTerm(models.Model):
+    ''' entry in the inverted index used by search.DatabaseSearchBackend '''
+    term = models.CharField(max_length=64)
+    article = models.ForeignKey(Article, related_name='+')
+    weight = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = (('term', 'article'),)
+
+
+def _materialize_older(version):
+    ''' store the version before version as a full copy if it's a delta,
+        before version's text is changed or deleted '''
+    older = ArticleVersion.objects.filter(
+        article=version.article_id, number__lt=version.number
+    ).order_by('-number')[:1]
+    for older_version in older:
+        if older_version.body_delta:
+            storage.materialize(older_version)
+
+def _version_pre_delete(sender, instance, **kwargs):
+    # the next older version may be stored as a delta against this one
+    _materialize_older(instance)
+
+def _version_deleted(sender, instance, **kwargs):
+    try:
+        article = Article.objects.get(pk=instance.article_id)
+    except Article.DoesNotExist:
+        return
+    if article.current_version_id in (None, instance.pk):
+        article.update_current_version()
+        article.update_links(article.current_version.body.raw
+                             if article.current_version else '')
+        search.update_index(article)
+
+models.signals.pre_delete.connect(_version_pre_delete, sender=ArticleVersion)
+models.signals.post_delete.connect(_version_deleted, sender=ArticleVersion)
@@ -0,0 +1,53 @@
+'''
+    limiting how often a user can change articles
+
+    Every edit, revert and rename counts against a budget of
+    MARKUPWIKI_EDITOR_RATE_LIMIT (or MARKUPWIKI_MODERATOR_RATE_LIMIT for
+    moderators) changes per MARKUPWIKI_RATE_LIMIT_SECONDS, counted per user
+    for logged in users and per IP address for anonymous ones.  A limit of
+    None disables limiting.
+
+    Counts live in the same cache as the article write locks and are kept as
+    a sliding window: hits in the previous window count in proportion to how
+    much of it still overlaps the last MARKUPWIKI_RATE_LIMIT_SECONDS.  Only
+    the cache is used, so throttled requests never reach the database.
+'''
+
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+RATE_LIMIT_SECONDS = getattr(settings, 'MARKUPWIKI_RATE_LIMIT_SECONDS', 60)
+EDITOR_RATE_LIMIT = getattr(settings, 'MARKUPWIKI_EDITOR_RATE_LIMIT', 10)
+MODERATOR_RATE_LIMIT = getattr(settings, 'MARKUPWIKI_MODERATOR_RATE_LIMIT', 60)
+
+def client_id(request):
+    if request.user.is_authenticated():
+        return 'user_%s' % request.user.pk
+    return 'ip_%s' % request.META.get('REMOTE_ADDR', '')
+
+def rate_key(ident, window):
+    return 'markupwiki_rate_%s_%s' % (ident, window)
+
+def hit(request, moderator=False):
+    ''' count a change made by request's user, returns False if that puts
+        them over their budget '''
+    limit = MODERATOR_RATE_LIMIT if moderator else EDITOR_RATE_LIMIT
+    if limit is None:
+        return True
+    ident = client_id(request)
+    now = time.time()
+    window, elapsed = divmod(now, RATE_LIMIT_SECONDS)
+    key = rate_key(ident, int(window))
+
+    # add is a no-op if the counter exists, incr is atomic on memcached
+    cache.add(key, 0, RATE_LIMIT_SECONDS * 2)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # evicted between add and incr
+        cache.add(key, 1, RATE_LIMIT_SECONDS * 2)
+        count = 1
+    previous = cache.get(rate_key(ident, int(window) - 1)) or 0
+    overlap = 1 - elapsed / RATE_LIMIT_SECONDS
+    return count + previous * overlap <= limit
@@ -0,0 +1,80 @@
+'''
+    recent changes across the wiki or to a single article
+
+    Changes are read newest first using the index on
+    ``ArticleVersion.timestamp`` without loading version bodies, and are
+    described by the number of lines added and removed (stored on each version
+    when it is written) rather than by the full body.
+
+    The feeds built from them are cached keyed on their ETag, which only
+    changes when a version is written or an article changes, so polling
+    clients are served from the cache.
+'''
+
+import hashlib
+from difflib import SequenceMatcher
+from django.conf import settings
+from django.db.models import Q
+from markupwiki.utils import title_key
+
+RECENT_CHANGES = getattr(settings, 'MARKUPWIKI_RECENT_CHANGES', 20)
+FEED_CACHE_SECONDS = getattr(settings, 'MARKUPWIKI_FEED_CACHE_SECONDS',
+                             60*60)
+
+def count_changes(old, new):
+    ''' return (lines added, lines removed) going from old to new '''
+    old_lines = old.splitlines()
+    new_lines = new.splitlines()
+    added = removed = 0
+    matcher = SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            removed += i2 - i1
+            added += j2 - j1
+    return added, removed
+
+def get_changes(article=None, section=None, author=None, status=None,
+                limit=RECENT_CHANGES):
+    ''' return the latest limit versions, optionally restricted to an article,
+        a section (and the sections in it), an author's username or an
+        article status '''
+    from markupwiki.models import ArticleVersion
+    versions = ArticleVersion.objects.select_related('article', 'author') \
+                .defer('body', '_body_rendered', 'body_delta')
+    if article is not None:
+        versions = versions.filter(article=article).order_by('-number')
+    else:
+        versions = versions.order_by('-timestamp')
+    if section:
+        section = title_key(section.rstrip('/'))
+        versions = versions.filter(
+            Q(article__section=section) |
+            Q(article__section__startswith=section + '/'))
+    if author:
+        versions = versions.filter(author__username=author)
+    if status is not None:
+        versions = versions.filter(article__status=status)
+    return versions[:limit]
+
+def describe(version):
+    ''' short text description of a change '''
+    parts = []
+    if version.comment:
+        parts.append(version.comment)
+    if version.lines_added is not None:
+        if version.number == 0:
+            parts.append('new article, %s lines' % version.lines_added)
+        else:
+            parts.append('+%s -%s lines' % (version.lines_added,
+                                            version.lines_removed))
+    if version.removed:
+        parts.append('removed')
+    description = ', '.join(parts) or 'edited'
+    if version.author_id:
+        description += ' by %s' % version.author.username
+    return description
+
+def feed_key(request, etag):
+    ''' cache key of the feed served for request while etag is current '''
+    ident = '%s|%s|%s' % (request.get_host(), request.get_full_path(), etag)
+    return 'markupwiki_feed_%s' % hashlib.md5(ident.encode('utf8')).hexdigest()
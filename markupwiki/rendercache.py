@@ -0,0 +1,75 @@
+'''
+    caching of article lookups and rendered article bodies
+
+    Two kinds of entries are kept:
+
+    * a head entry per title holding the ``Article`` (with its head
+      ``ArticleVersion`` already loaded) so that a warm ``view_article``
+      needs no queries
+    * the rendered body of a version, keyed on the version (see version_key)
+      and markup type (only an in-place edit of a version, eg. through the
+      admin, needs to invalidate these)
+'''
+
+import hashlib
+from django.conf import settings
+from django.core.cache import get_cache
+from django.utils.safestring import mark_safe
+from markupwiki.utils import title_key
+
+CACHE_ALIAS = getattr(settings, 'MARKUPWIKI_RENDER_CACHE', 'default')
+CACHE_SECONDS = getattr(settings, 'MARKUPWIKI_RENDER_CACHE_SECONDS', 60*60)
+
+_cache = None
+
+def get_render_cache():
+    global _cache
+    if _cache is None:
+        _cache = get_cache(CACHE_ALIAS)
+    return _cache
+
+def head_key(title):
+    # keyed on title_key so every spelling of a title shares an entry, and
+    # hashed since titles can contain characters memcached doesn't allow
+    title = title_key(title)
+    if isinstance(title, unicode):
+        title = title.encode('utf8')
+    return 'markupwiki_head_%s' % hashlib.md5(title).hexdigest()
+
+def version_key(pk, timestamp):
+    ''' identifies a version in cache keys
+
+        version numbers are reused after the head is deleted and so can pks
+        (eg. sqlite reuses the highest one), the pair with the timestamp
+        isn't
+    '''
+    return '%s_%s' % (pk, timestamp.strftime('%Y%m%d%H%M%S%f'))
+
+def rendered_key(pk, timestamp, markup_type):
+    return 'markupwiki_rendered_%s_%s' % (version_key(pk, timestamp),
+                                          markup_type)
+
+def get_head(title):
+    ''' return cached article for title or None '''
+    return get_render_cache().get(head_key(title))
+
+def set_head(article):
+    get_render_cache().set(head_key(article.title), article, CACHE_SECONDS)
+
+def invalidate_title(title):
+    get_render_cache().delete(head_key(title))
+
+def invalidate_rendered(version):
+    get_render_cache().delete(rendered_key(version.pk, version.timestamp,
+                                           version.body_markup_type))
+
+def get_rendered(version):
+    ''' return the rendered body of version, using the cache if possible '''
+    cache = get_render_cache()
+    key = rendered_key(version.pk, version.timestamp,
+                       version.body_markup_type)
+    rendered = cache.get(key)
+    if rendered is None:
+        rendered = unicode(version.restore_body())
+        cache.set(key, rendered, CACHE_SECONDS)
+    return mark_safe(rendered)
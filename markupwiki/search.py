@@ -0,0 +1,262 @@
+'''
+    full text search over the head version of each article
+
+    Only articles that are not deleted and not redirects are indexed.  The
+    backend is chosen with MARKUPWIKI_SEARCH_BACKEND:
+
+    markupwiki.search.DatabaseSearchBackend
+        inverted index stored in the ``SearchTerm`` table, works on any
+        database (default)
+    markupwiki.search.SQLiteFTSBackend
+        SQLite FTS5 virtual table
+    markupwiki.search.PostgresSearchBackend
+        PostgreSQL tsvector column with a GIN index
+'''
+
+import re
+from django.conf import settings
+from django.db import connection
+from django.utils.html import escape
+from django.utils.importlib import import_module
+from django.utils.safestring import mark_safe
+
+SEARCH_BACKEND = getattr(settings, 'MARKUPWIKI_SEARCH_BACKEND',
+                         'markupwiki.search.DatabaseSearchBackend')
+SEARCH_RESULTS = getattr(settings, 'MARKUPWIKI_SEARCH_RESULTS', 20)
+SNIPPET_LENGTH = getattr(settings, 'MARKUPWIKI_SEARCH_SNIPPET_LENGTH', 200)
+
+TITLE_WEIGHT = 10
+MAX_TERM_LENGTH = 64
+
+term_re = re.compile(r'\w+', re.UNICODE)
+
+# markers placed around matches by the database before the snippet is escaped
+_START, _STOP = u'\x02', u'\x03'
+
+def tokenize(text):
+    ''' return the list of lowercased terms in text '''
+    return [t for t in term_re.findall(text.lower())
+            if 1 < len(t) <= MAX_TERM_LENGTH]
+
+def _marked_snippet(marked):
+    ''' escape a snippet with _START/_STOP markers and turn the markers into
+        highlighting '''
+    html = escape(marked).replace(_START, '<strong>').replace(_STOP,
+                                                              '</strong>')
+    return mark_safe(html)
+
+def make_snippet(text, terms, length=SNIPPET_LENGTH):
+    ''' return an html snippet of text around the first of terms with every
+        occurrence of terms highlighted '''
+    if not terms:
+        return escape(text[:length])
+    terms_re = re.compile(r'\b(%s)\b' % '|'.join(re.escape(t) for t in terms),
+                          re.IGNORECASE | re.UNICODE)
+    match = terms_re.search(text)
+    start = max(0, match.start() - length // 2) if match else 0
+    snippet = text[start:start+length]
+    marked = terms_re.sub(lambda m: _START + m.group(0) + _STOP, snippet)
+    if start > 0:
+        marked = u'...' + marked
+    if start + length < len(text):
+        marked += u'...'
+    return _marked_snippet(marked)
+
+
+class BaseSearchBackend(object):
+
+    def update(self, article_id, title, text):
+        ''' (re)index an article '''
+        raise NotImplementedError()
+
+    def remove(self, article_id):
+        ''' remove an article from the index '''
+        raise NotImplementedError()
+
+    def clear(self):
+        ''' remove everything from the index '''
+        raise NotImplementedError()
+
+    def search(self, query, limit):
+        ''' return up to limit (article_id, score, snippet) tuples matching
+            query, best matches first '''
+        raise NotImplementedError()
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    ''' inverted index of term -> (article, weight) in the SearchTerm table
+
+        A query returns the articles containing every term, ranked by the sum
+        of the term weights.  Matching is done entirely on the indexed term
+        column.
+    '''
+
+    def update(self, article_id, title, text):
+        from markupwiki.models import SearchTerm
+        weights = {}
+        for term in tokenize(text):
+            weights[term] = weights.get(term, 0) + 1
+        for term in tokenize(title):
+            weights[term] = weights.get(term, 0) + TITLE_WEIGHT
+        self.remove(article_id)
+        SearchTerm.objects.bulk_create(
+            [SearchTerm(article_id=article_id, term=term, weight=weight)
+             for term, weight in weights.items()])
+
+    def remove(self, article_id):
+        from markupwiki.models import SearchTerm
+        SearchTerm.objects.filter(article=article_id).delete()
+
+    def clear(self):
+        from markupwiki.models import SearchTerm
+        SearchTerm.objects.all().delete()
+
+    def search(self, query, limit):
+        from django.db.models import Count, Sum
+        from markupwiki.models import Article, SearchTerm
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        hits = list(SearchTerm.objects.filter(term__in=terms)
+                    .values('article')
+                    .annotate(score=Sum('weight'), matched=Count('term'))
+                    .filter(matched=len(terms))
+                    .order_by('-score')[:limit])
+        bodies = dict(Article.objects.filter(
+            pk__in=[h['article'] for h in hits]).values_list(
+                'pk', 'current_version__body'))
+        return [(h['article'], h['score'],
+                 make_snippet(bodies.get(h['article']) or '', terms))
+                for h in hits]
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    ''' index stored in an SQLite FTS5 virtual table ranked with bm25 '''
+
+    table = 'markupwiki_fts'
+
+    _table_created = False
+
+    def _cursor(self):
+        cursor = connection.cursor()
+        if not self._table_created:
+            cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS %s '
+                           'USING fts5(title, body)' % self.table)
+            self._table_created = True
+        return cursor
+
+    def update(self, article_id, title, text):
+        cursor = self._cursor()
+        cursor.execute('DELETE FROM %s WHERE rowid = %%s' % self.table,
+                       [article_id])
+        cursor.execute('INSERT INTO %s (rowid, title, body) '
+                       'VALUES (%%s, %%s, %%s)' % self.table,
+                       [article_id, title, text])
+
+    def remove(self, article_id):
+        self._cursor().execute('DELETE FROM %s WHERE rowid = %%s' % self.table,
+                               [article_id])
+
+    def clear(self):
+        self._cursor().execute('DELETE FROM %s' % self.table)
+
+    def search(self, query, limit):
+        terms = tokenize(query)
+        if not terms:
+            return []
+        # quote every term so user input can't use FTS query syntax
+        match = ' '.join('"%s"' % t for t in terms)
+        cursor = self._cursor()
+        cursor.execute(
+            "SELECT rowid, -bm25({0}, %s, 1.0), "
+            "snippet({0}, 1, %s, %s, '...', 32) "
+            "FROM {0} WHERE {0} MATCH %s "
+            "ORDER BY bm25({0}, %s, 1.0) LIMIT %s".format(self.table),
+            [TITLE_WEIGHT, _START, _STOP, match, TITLE_WEIGHT, limit])
+        return [(pk, score, _marked_snippet(snippet))
+                for pk, score, snippet in cursor.fetchall()]
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    ''' index stored as a tsvector column with a GIN index, ranked with
+        ts_rank '''
+
+    table = 'markupwiki_search'
+    config = getattr(settings, 'MARKUPWIKI_SEARCH_CONFIG', 'english')
+
+    _table_created = False
+
+    def _cursor(self):
+        cursor = connection.cursor()
+        if not self._table_created:
+            cursor.execute('CREATE TABLE IF NOT EXISTS %s ('
+                           'article_id integer PRIMARY KEY, '
+                           'document tsvector NOT NULL)' % self.table)
+            cursor.execute('CREATE INDEX IF NOT EXISTS %s_document ON %s '
+                           'USING gin(document)' % (self.table, self.table))
+            self._table_created = True
+        return cursor
+
+    def update(self, article_id, title, text):
+        cursor = self._cursor()
+        cursor.execute('DELETE FROM %s WHERE article_id = %%s' % self.table,
+                       [article_id])
+        cursor.execute(
+            'INSERT INTO %s (article_id, document) VALUES (%%s, '
+            "setweight(to_tsvector(%%s, %%s), 'A') || "
+            "setweight(to_tsvector(%%s, %%s), 'B'))" % self.table,
+            [article_id, self.config, title, self.config, text])
+
+    def remove(self, article_id):
+        self._cursor().execute('DELETE FROM %s WHERE article_id = %%s' %
+                               self.table, [article_id])
+
+    def clear(self):
+        self._cursor().execute('DELETE FROM %s' % self.table)
+
+    def search(self, query, limit):
+        from markupwiki.models import Article, ArticleVersion
+        cursor = self._cursor()
+        cursor.execute(
+            'SELECT s.article_id, ts_rank(s.document, q), '
+            "ts_headline(%s, v.body, q, %s) "
+            'FROM {search} s, plainto_tsquery(%s, %s) q, {article} a, '
+            '{version} v '
+            'WHERE s.document @@ q AND a.id = s.article_id '
+            'AND v.id = a.current_version_id '
+            'ORDER BY 2 DESC LIMIT %s'.format(
+                search=self.table, article=Article._meta.db_table,
+                version=ArticleVersion._meta.db_table),
+            [self.config, 'StartSel=%s, StopSel=%s' % (_START, _STOP),
+             self.config, query, limit])
+        return [(pk, score, _marked_snippet(snippet))
+                for pk, score, snippet in cursor.fetchall()]
+
+
+_backend = None
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        module, cls = SEARCH_BACKEND.rsplit('.', 1)
+        _backend = getattr(import_module(module), cls)()
+    return _backend
+
+def update_index(article):
+    ''' bring the index entry for article up to date '''
+    from markupwiki.models import DELETED
+    backend = get_backend()
+    if (article.status == DELETED or article.redirect_to_id or
+        not article.current_version_id):
+        backend.remove(article.pk)
+    else:
+        backend.update(article.pk, article.title,
+                       article.current_version.body.raw)
+
+def search(query, limit=SEARCH_RESULTS):
+    ''' return a list of (article, score, snippet) for query '''
+    from markupwiki.models import Article
+    hits = get_backend().search(query, limit)
+    articles = Article.objects.in_bulk([pk for pk, score, snippet in hits])
+    return [(articles[pk], score, snippet) for pk, score, snippet in hits
+            if pk in articles]
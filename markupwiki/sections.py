@@ -0,0 +1,73 @@
+'''
+    rendering and editing article bodies by section
+
+    A body is split into sections at markdown (ATX style, ``# heading``)
+    headings.  For the markup types in MARKUPWIKI_SECTION_MARKUP_TYPES bodies
+    of at least MARKUPWIKI_SECTION_RENDER_MIN_SIZE characters are rendered one
+    section at a time, with each section's html cached under a hash of its
+    text, so saving a large article only renders the sections that changed.
+
+    Rendering sections separately only gives the same html as rendering the
+    whole body when nothing spans sections, so bodies with fenced code
+    blocks, reference style links or footnotes and raw html blocks are always
+    rendered whole.
+'''
+
+import hashlib
+import re
+from django.conf import settings
+from django.utils.functional import wraps
+from markupwiki import rendercache
+
+SECTION_MARKUP_TYPES = getattr(settings, 'MARKUPWIKI_SECTION_MARKUP_TYPES',
+                               ('markdown',))
+SECTION_RENDER_MIN_SIZE = getattr(settings,
+                                  'MARKUPWIKI_SECTION_RENDER_MIN_SIZE', 10000)
+
+heading_re = re.compile(r'^#{1,6}[ \t]', re.MULTILINE)
+# constructs that can make text in one section change another's html
+spanning_re = re.compile(r'^ {0,3}(```|~~~|\[[^\]]+\]:|<[a-zA-Z!/])',
+                         re.MULTILINE)
+
+def split_sections(text):
+    ''' split text before each heading, ''.join(sections) == text '''
+    starts = [m.start() for m in heading_re.finditer(text) if m.start()]
+    ends = starts + [len(text)]
+    starts = [0] + starts
+    return [text[start:end] for start, end in zip(starts, ends)]
+
+def replace_section(text, n, section_text):
+    ''' return text with its nth section replaced by section_text '''
+    sections = split_sections(text)
+    if not 0 <= n < len(sections):
+        raise IndexError('no section %s' % n)
+    if n < len(sections) - 1 and not section_text.endswith('\n'):
+        section_text += '\n'
+    sections[n] = section_text
+    return ''.join(sections)
+
+def section_key(markup_type, text):
+    if isinstance(text, unicode):
+        text = text.encode('utf8')
+    return 'markupwiki_section_%s_%s' % (markup_type,
+                                         hashlib.md5(text).hexdigest())
+
+def section_markup_wrapper(markup_type, func):
+    ''' wrap a markup function so that large bodies are rendered section by
+        section using cached html for unchanged sections '''
+    def render(text):
+        if markup_type not in SECTION_MARKUP_TYPES or \
+                len(text) < SECTION_RENDER_MIN_SIZE or spanning_re.search(text):
+            return func(text)
+        sections = split_sections(text)
+        keys = [section_key(markup_type, section) for section in sections]
+        cache = rendercache.get_render_cache()
+        rendered = cache.get_many(keys)
+        new = {}
+        for key, section in zip(keys, sections):
+            if key not in rendered:
+                rendered[key] = new[key] = func(section)
+        if new:
+            cache.set_many(new, rendercache.CACHE_SECONDS)
+        return '\n'.join(filter(None, [rendered[key] for key in keys]))
+    return wraps(func)(render)
@@ -0,0 +1,102 @@
+'''
+    delta compressed storage of old article versions
+
+    With MARKUPWIKI_REVISION_STORAGE = 'delta' a version that stops being the
+    head of its article is stored as a compressed reverse delta against the
+    next newer version and its rendered html is dropped.  Every
+    MARKUPWIKI_SNAPSHOT_INTERVAL-th version is kept as a full copy so that
+    rebuilding a version never needs more than that many deltas.  The head
+    version is always a full copy.
+
+    Stored deltas are a zlib compressed JSON list where ``[i, j]`` copies lines
+    i to j of the newer version and a string is inserted text.
+'''
+
+import base64
+import json
+import zlib
+from difflib import SequenceMatcher
+from django.conf import settings
+
+REVISION_STORAGE = getattr(settings, 'MARKUPWIKI_REVISION_STORAGE', 'full')
+SNAPSHOT_INTERVAL = getattr(settings, 'MARKUPWIKI_SNAPSHOT_INTERVAL', 20)
+
+def encode_delta(base, target):
+    ''' return a delta that rebuilds target from base '''
+    base_lines = base.splitlines(True)
+    target_lines = target.splitlines(True)
+    ops = []
+    matcher = SequenceMatcher(None, base_lines, target_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j1 != j2:
+            ops.append(''.join(target_lines[j1:j2]))
+    data = zlib.compress(json.dumps(ops).encode('utf8'))
+    return base64.b64encode(data).decode('ascii')
+
+def apply_delta(base, delta):
+    ''' rebuild the text encoded by delta from base '''
+    base_lines = base.splitlines(True)
+    ops = json.loads(zlib.decompress(base64.b64decode(delta)).decode('utf8'))
+    parts = []
+    for op in ops:
+        if isinstance(op, list):
+            parts.extend(base_lines[op[0]:op[1]])
+        else:
+            parts.append(op)
+    return ''.join(parts)
+
+def is_snapshot(number):
+    return number % SNAPSHOT_INTERVAL == 0
+
+def compress_version(version_id, newer_raw):
+    ''' store the version with pk version_id as a delta against newer_raw '''
+    from markupwiki.models import ArticleVersion
+    try:
+        number, raw = ArticleVersion.objects.filter(pk=version_id).values_list(
+            'number', 'body')[0]
+    except IndexError:
+        return
+    if is_snapshot(number):
+        return
+    ArticleVersion.objects.filter(pk=version_id).update(
+        body='', _body_rendered='', body_delta=encode_delta(newer_raw, raw))
+
+def rebuild_raw(version):
+    ''' return the raw body of a delta stored version '''
+    from markupwiki.models import ArticleVersion
+    deltas = [version.body_delta]
+    newer = ArticleVersion.objects.filter(
+        article=version.article_id, number__gt=version.number
+    ).order_by('number').values_list('body', 'body_delta')
+    for body, delta in newer.iterator():
+        if not delta:
+            raw = body
+            break
+        deltas.append(delta)
+    else:
+        raise ValueError('no full copy to rebuild %s from' % version)
+
+    for delta in reversed(deltas):
+        raw = apply_delta(raw, delta)
+    return raw
+
+def iter_raw_bodies(article):
+    ''' yield (version, raw) for every version of article, newest first,
+        rebuilding delta stored versions along the way '''
+    newer_raw = None
+    versions = article.versions.select_related('author').order_by('-number')
+    for version in versions.iterator():
+        if version.body_delta:
+            raw = apply_delta(newer_raw, version.body_delta)
+        else:
+            raw = version.body.raw
+        yield version, raw
+        newer_raw = raw
+
+def materialize(version):
+    ''' turn a delta stored version back into a full copy '''
+    from markupwiki.models import ArticleVersion
+    ArticleVersion.objects.filter(pk=version.pk).update(
+        body=rebuild_raw(version), body_delta='')
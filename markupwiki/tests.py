@@ -1,14 +1,30 @@
+import datetime
+import json
+import os
+import tempfile
 import time
+from django.conf import settings
 from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.test import TestCase
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
+from django.test.signals import setting_changed
+from django.utils.six import StringIO
 from django.http import HttpRequest
 from django.contrib.auth.models import User, AnonymousUser
-from markupwiki.models import Article, ArticleVersion, PUBLIC, LOCKED, DELETED
+from markupwiki.models import (Article, ArticleVersion, RedirectLoop, PUBLIC,
+                               LOCKED, DELETED)
 from markupwiki import models
-from markupwiki.utils import make_wiki_links, wikify_markup_wrapper
-from markupwiki import views
+from markupwiki.utils import (make_wiki_links, wikify_markup_wrapper,
+                              canonicalize_title, title_key)
+from markupwiki import (views, instrumentation, search, storage, workers, diff,
+                        sections, ratelimit)
+from markupwiki.diff import make_diff
+from markupwiki.conf import reset_on_setting_changed
+
+setting_changed.connect(reset_on_setting_changed)
 
 class ArticleTests(TestCase):
 
@@ -83,6 +99,12 @@ class ArticleWriteLockTests(TestCase):
         self.assertTrue(alice_release_lock)
         self.assertTrue(bob_immediate_lock)
 
+    def test_release_other_lock(self):
+        ''' test that releasing doesn't drop someone else's lock '''
+        self.article.get_write_lock(self.alice)
+        self.assertFalse(self.article.get_write_lock(self.bob, release=True))
+        self.assertFalse(self.article.get_write_lock(self.bob))
+
     def test_release_on_acquire(self):
         ''' test that if release is True on acquire lock is not set '''
         alice_initial_lock = self.article.get_write_lock(self.alice, release=True)
@@ -104,7 +126,7 @@ class WikifyTests(TestCase):
         result = make_wiki_links('[[test]]')
         self.assertEquals(result, self._get_url('test'))
         result = make_wiki_links('[[two words ]]')
-        self.assertEquals(result, self._get_url('two words'))
+        self.assertEquals(result, self._get_url('two_words', 'two words'))
         result_ws = make_wiki_links('[[ test ]]')
         self.assertEquals(result_ws, self._get_url('test'))
 
@@ -112,6 +134,18 @@ class WikifyTests(TestCase):
         result = make_wiki_links('[[test|this link has a name]]')
         self.assertEquals(result, self._get_url('test', 'this link has a name'))
 
+    def test_make_wiki_links_resolve(self):
+        ''' test that resolved links follow redirects and mark missing pages '''
+        target = Article.objects.create(title='target')
+        Article.objects.create(title='old', redirect_to=target)
+        result = make_wiki_links('[[target]] [[old]] [[nowhere]]',
+                                 resolve=True)
+        self.assertEquals(result, ' '.join((
+            self._get_url('target'),
+            '<a href="%s">old</a>' % reverse('view_article', args=['target']),
+            '<a href="%s" class="missing">nowhere</a>' %
+                reverse('view_article', args=['nowhere']))))
+
     def test_wikify_markup_wrapper(self):
         wrapped_upper_filter = wikify_markup_wrapper(lambda text: text.upper())
 
@@ -309,6 +343,995 @@ class EditArticleTests(ViewTestsBase):
         self.assertContains(resp, 'Your session timed out')
 
 
+class CurrentVersionTests(ViewTestsBase):
+
+    def test_pointer_follows_new_versions(self):
+        ''' test that creating versions keeps the head pointer up to date '''
+        article = Article.objects.get(title='test')
+        self.assertEquals(article.latest_number, 2)
+        self.assertEquals(article.current_version.body.raw,
+                          'this is the final update')
+
+    def test_edit_updates_pointer(self):
+        ''' test that an edit through the view moves the head pointer '''
+        self.login_as_user()
+        self.client.post('/wiki/test/edit/', {'body': 'pointer test',
+                                              'comment': '',
+                                              'body_markup_type': 'markdown'})
+        article = Article.objects.get(title='test')
+        self.assertEquals(article.latest_number, 3)
+        self.assertEquals(article.current_version.number, 3)
+
+    def test_revert_updates_pointer(self):
+        ''' test that revert creates a new head with the next number '''
+        self.login_as_admin()
+        self.client.post('/wiki/test/revert/', {'revision': 0})
+        article = Article.objects.get(title='test')
+        self.assertEquals(article.latest_number, 3)
+        self.assertEquals(article.current_version.body.raw, 'this is a test')
+
+    def test_delete_head(self):
+        ''' test that deleting the head version falls back to the previous one '''
+        self.test_article.versions.get(number=2).delete()
+        article = Article.objects.get(title='test')
+        self.assertEquals(article.latest_number, 1)
+        self.assertEquals(article.current_version.number, 1)
+
+    def test_stale_save_keeps_pointer(self):
+        ''' test that saving a stale Article doesn't move the head back '''
+        stale = Article.objects.get(title='test')
+        ArticleVersion.objects.create(article=self.test_article,
+                                      author=self.frank, number=3,
+                                      body='concurrent edit')
+        stale.status = LOCKED
+        stale.save()
+        article = Article.objects.get(title='test')
+        self.assertEquals(article.latest_number, 3)
+        self.assertEquals(article.current_version.number, 3)
+        self.assertEquals(article.status, LOCKED)
+
+
+class RenderCacheTests(ViewTestsBase):
+
+    def _view(self, title):
+        request = RequestFactory().get('/wiki/%s/' % title)
+        request.user = AnonymousUser()
+        return views.view_article(request, title)
+
+    def test_warm_view_is_query_free(self):
+        ''' test that a cached article view doesn't touch the database '''
+        self._view('test')
+        with self.assertNumQueries(0):
+            resp = self._view('test')
+        self.assertContains(resp, 'this is the final update')
+
+    def test_edit_invalidates(self):
+        ''' test that saving a new version invalidates the cached page '''
+        self._view('test')
+        ArticleVersion.objects.create(article=self.test_article,
+                                      author=self.frank, number=3,
+                                      body='cache buster')
+        self.assertContains(self._view('test'), 'cache buster')
+
+    def test_status_change_invalidates(self):
+        ''' test that changing status invalidates the cached page '''
+        self._view('test')
+        self.test_article.status = DELETED
+        self.test_article.save()
+        self.assertContains(self._view('test'), 'This article has been deleted')
+
+    def test_reused_number(self):
+        ''' test that a number reused after deleting the head isn't served
+            the deleted version's cached html '''
+        self.client.get('/wiki/test/history/2/')
+        self.test_article.versions.get(number=2).delete()
+        ArticleVersion.objects.create(article=self.test_article,
+                                      author=self.frank, number=2,
+                                      body='a different update')
+        resp = self.client.get('/wiki/test/history/2/')
+        self.assertContains(resp, 'a different update')
+
+
+class BacklinkTests(ViewTestsBase):
+
+    def test_links_follow_head(self):
+        ''' test that the link index tracks the head version '''
+        ArticleVersion.objects.create(article=self.two_word_article,
+                                      author=self.frank, number=1,
+                                      body='see [[test]] and [[locked|this]]')
+        self.assertEquals(list(self.test_article.get_backlinks()),
+                          [self.two_word_article])
+
+        ArticleVersion.objects.create(article=self.two_word_article,
+                                      author=self.frank, number=2,
+                                      body='only [[locked]] now')
+        self.assertEquals(list(self.test_article.get_backlinks()), [])
+        self.assertEquals(list(self.locked.get_backlinks()),
+                          [self.two_word_article])
+
+    def test_backlinks_view(self):
+        ''' test that the what links here page lists linking articles '''
+        ArticleVersion.objects.create(article=self.two_word_article,
+                                      author=self.frank, number=1,
+                                      body='see [[test]]')
+        resp = self.client.get('/wiki/test/links/')
+        self.assertContains(resp, '/wiki/two_words/')
+
+
+class DiffTests(ViewTestsBase):
+
+    def test_diff_modes(self):
+        ''' test that each diff mode shows the changed text '''
+        for mode in ('full', 'context', 'inline'):
+            resp = self.client.get('/wiki/test/diff/',
+                                   {'from': 0, 'to': 2, 'mode': mode})
+            self.assertContains(resp, 'final')
+
+    def test_inline_word_diff(self):
+        ''' test that inline mode marks changed words '''
+        html, truncated = make_diff('this is a test', 'this is the test',
+                                    mode='inline')
+        self.assertTrue('<del>a</del><ins>the</ins>' in html)
+        self.assertFalse(truncated)
+
+    def test_max_lines(self):
+        ''' test that long diffs are truncated '''
+        html, truncated = make_diff('a\n' * 50, 'b\n' * 50, mode='full',
+                                    max_lines=10)
+        self.assertTrue(truncated)
+
+    def test_large_diff_inline(self):
+        ''' test that large inputs get the bounded inline diff '''
+        html, truncated = make_diff('a\n' * 600, 'b\n' * 600, mode='context')
+        self.assertTrue('diff_inline' in html)
+        html, truncated = make_diff('a\n' * 30, 'b\n' * 30, mode='full')
+        self.assertTrue('diff_inline' in html)
+
+    def test_missing_version(self):
+        ''' test that comparing a nonexistent version 404s '''
+        resp = self.client.get('/wiki/test/diff/', {'from': 0, 'to': 9})
+        self.assertEquals(resp.status_code, 404)
+
+    def test_slow_diff(self):
+        ''' test that a placeholder is shown while a slow diff is built '''
+        def slow_diff(*args):
+            time.sleep(0.2)
+            return 'slow diff', False
+        diff._diff_and_cache, old = slow_diff, diff._diff_and_cache
+        workers.WORKER_TIMEOUT, old_timeout = 0.01, workers.WORKER_TIMEOUT
+        try:
+            resp = self.client.get('/wiki/test/diff/',
+                                   {'from': 0, 'to': 2, 'mode': 'full'})
+        finally:
+            diff._diff_and_cache = old
+            workers.WORKER_TIMEOUT = old_timeout
+        self.assertContains(resp, 'diff_pending')
+        self.assertNotContains(resp, 'slow diff')
+
+
+class WorkerTests(TestCase):
+
+    def test_run(self):
+        ''' test that run returns the function's result '''
+        self.assertEquals(workers.run(sum, ([1, 2, 3],)), 6)
+
+    def test_timeout(self):
+        ''' test that run gives up on slow functions '''
+        self.assertRaises(workers.WorkerTimeout, workers.run, time.sleep,
+                          (0.2,), timeout=0.01)
+
+    def test_same_key_shares_call(self):
+        ''' test that calls with the same key run once '''
+        calls = []
+        def slow(n):
+            calls.append(n)
+            time.sleep(0.1)
+            return n
+        self.assertRaises(workers.WorkerTimeout, workers.run, slow, (1,),
+                          timeout=0.01, key='slow')
+        self.assertEquals(workers.run(slow, (1,), key='slow'), 1)
+        self.assertEquals(calls, [1])
+
+
+class DeltaStorageTests(ViewTestsBase):
+
+    def setUp(self):
+        self.revision_storage = storage.REVISION_STORAGE
+        storage.REVISION_STORAGE = 'delta'
+        super(DeltaStorageTests, self).setUp()
+
+    def tearDown(self):
+        storage.REVISION_STORAGE = self.revision_storage
+
+    def test_delta_roundtrip(self):
+        ''' test that deltas rebuild the original text '''
+        old = 'line one\nline two\nline three\n'
+        new = 'line one\nline 2\nline three\nline four\n'
+        self.assertEquals(storage.apply_delta(new, storage.encode_delta(new, old)),
+                          old)
+
+    def test_old_versions_compressed(self):
+        ''' test that versions are stored as deltas once they stop being head '''
+        versions = dict((v.number, v) for v in self.test_article.versions.all())
+        self.assertEquals(versions[0].body_delta, '')   # snapshot
+        self.assertNotEquals(versions[1].body_delta, '')
+        self.assertEquals(versions[1].body.raw, '')
+        self.assertEquals(versions[2].body_delta, '')   # head
+        self.assertEquals(versions[1].restore_body().raw, 'this is an update')
+
+    def test_view_old_version(self):
+        ''' test that delta stored versions can be viewed and diffed '''
+        resp = self.client.get('/wiki/test/history/1/')
+        self.assertContains(resp, 'this is an update')
+        resp = self.client.get('/wiki/test/diff/', {'from': 1, 'to': 2,
+                                                    'mode': 'inline'})
+        self.assertContains(resp, '<del>an</del><ins>the final</ins>')
+
+    def test_delete_base_version(self):
+        ''' test that deleting the version a delta is based on keeps history '''
+        ArticleVersion.objects.create(article=self.test_article,
+                                      author=self.frank, number=3,
+                                      body='yet another update')
+        self.test_article.versions.get(number=3).delete()
+        version = self.test_article.versions.get(number=2)
+        self.assertEquals(version.restore_body().raw, 'this is the final update')
+
+    def test_edit_head_in_place(self):
+        ''' test that editing the head in place keeps older versions intact '''
+        head = self.test_article.versions.get(number=2)
+        head.body = 'an edit made in the admin'
+        head.save()
+        version = self.test_article.versions.get(number=1)
+        self.assertEquals(version.restore_body().raw, 'this is an update')
+
+
+class HistoryTests(ViewTestsBase):
+
+    def test_history(self):
+        ''' test that history lists revisions newest first '''
+        resp = self.client.get('/wiki/test/history/')
+        self.assertEquals([v.number for v in resp.context['versions']],
+                          [2, 1, 0])
+        self.assertEquals(resp.context['next_before'], None)
+
+    def test_history_pagination(self):
+        ''' test that history pages are keyed on revision number '''
+        old, views.HISTORY_PAGE_SIZE = views.HISTORY_PAGE_SIZE, 2
+        try:
+            resp = self.client.get('/wiki/test/history/')
+            self.assertEquals([v.number for v in resp.context['versions']],
+                              [2, 1])
+            self.assertEquals(resp.context['next_before'], 1)
+            resp = self.client.get('/wiki/test/history/', {'before': 1})
+            self.assertEquals([v.number for v in resp.context['versions']],
+                              [0])
+        finally:
+            views.HISTORY_PAGE_SIZE = old
+
+    def test_history_json(self):
+        ''' test the JSON variant of the history view '''
+        resp = self.client.get('/wiki/test/history/json/')
+        data = json.loads(resp.content.decode('utf8'))
+        self.assertEquals([v['number'] for v in data['versions']], [2, 1, 0])
+        self.assertEquals(data['versions'][0]['author'], 'frank')
+
+
+class SearchTests(ViewTestsBase):
+
+    def test_search_head_only(self):
+        ''' test that only the head version of an article is searched '''
+        self.assertEquals([a for a, score, snippet in search.search('final')],
+                          [self.test_article])
+        self.assertEquals(search.search('an update'), [])
+
+    def test_search_excludes_deleted(self):
+        ''' test that deleted articles drop out of the index '''
+        self.test_article.status = DELETED
+        self.test_article.save()
+        self.assertEquals(search.search('final'), [])
+
+    def test_snippet(self):
+        ''' test that snippets are escaped and highlight the search terms '''
+        snippet = search.make_snippet('<b>a</b> final update', ['final'])
+        self.assertEquals(snippet,
+                          '&lt;b&gt;a&lt;/b&gt; <strong>final</strong> update')
+
+    def test_search_view(self):
+        ''' test that search results highlight the query '''
+        resp = self.client.get('/wiki/search/', {'q': 'lockdown'})
+        self.assertContains(resp, '<strong>lockdown</strong>')
+
+
+class ConditionalGetTests(ViewTestsBase):
+
+    def test_article_not_modified(self):
+        ''' test that a matching ETag gets a 304 '''
+        resp = self.client.get('/wiki/test/')
+        resp = self.client.get('/wiki/test/', HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEquals(resp.status_code, 304)
+
+    def test_etag_changes(self):
+        ''' test that new versions and status changes change the ETag '''
+        etag = self.client.get('/wiki/test/')['ETag']
+        ArticleVersion.objects.create(article=self.test_article,
+                                      author=self.frank, number=3,
+                                      body='new etag')
+        new_etag = self.client.get('/wiki/test/')['ETag']
+        self.assertNotEquals(etag, new_etag)
+        self.test_article.status = LOCKED
+        self.test_article.save()
+        self.assertNotEquals(new_etag, self.client.get('/wiki/test/')['ETag'])
+
+    def test_logged_in_no_etag(self):
+        ''' test that pages for logged in users aren't given validators '''
+        self.login_as_user()
+        self.assertFalse(self.client.get('/wiki/test/').has_header('ETag'))
+
+    def test_revision_cache_control(self):
+        ''' test that old revisions are marked as publicly cacheable '''
+        resp = self.client.get('/wiki/test/history/1/')
+        self.assertTrue('public' in resp['Cache-Control'])
+
+    def test_feed_not_modified(self):
+        ''' test that an unchanged article feed is answered with a 304 '''
+        resp = self.client.get('/wiki/test/rss/')
+        resp = self.client.get('/wiki/test/rss/', HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEquals(resp.status_code, 304)
+
+
+class AddVersionTests(ViewTestsBase):
+
+    def test_add_version_numbers(self):
+        ''' test that add_version allocates the next number '''
+        version = self.test_article.add_version(
+            ArticleVersion(author=self.frank, body='next'))
+        self.assertEquals(version.number, 3)
+        self.assertEquals(Article.objects.get(pk=self.test_article.pk)
+                          .latest_number, 3)
+
+    def test_add_version_stale_article(self):
+        ''' test that a stale Article instance still gets a fresh number '''
+        stale = Article.objects.get(pk=self.test_article.pk)
+        self.test_article.add_version(ArticleVersion(author=self.frank,
+                                                     body='first'))
+        version = stale.add_version(ArticleVersion(author=self.frank,
+                                                   body='second'))
+        self.assertEquals(version.number, 4)
+
+    def test_add_version_conflict(self):
+        ''' test that a mismatched base revision raises EditConflict '''
+        self.assertRaises(models.EditConflict, self.test_article.add_version,
+                          ArticleVersion(author=self.frank, body='x'),
+                          base_number=1)
+
+
+class OptimisticEditTests(ViewTestsBase):
+
+    def setUp(self):
+        super(OptimisticEditTests, self).setUp()
+        self.edit_mode = views.EDIT_MODE
+        views.EDIT_MODE = 'optimistic'
+        ArticleVersion.objects.create(article=self.test_article,
+                                      author=self.admin, number=3,
+                                      body='one\ntwo\nthree\n')
+
+    def tearDown(self):
+        views.EDIT_MODE = self.edit_mode
+
+    def _post(self, body, base):
+        return self.client.post('/wiki/test/edit/',
+                                {'body': body, 'comment': '',
+                                 'body_markup_type': 'markdown',
+                                 'base_revision': base})
+
+    def test_no_lock_needed(self):
+        ''' test that optimistic edits ignore write locks '''
+        self.login_as_admin()
+        self.client.get('/wiki/test/edit/')
+        self.login_as_user()
+        resp = self._post('one\ntwo\nthree\nfour\n', 3)
+        self.assertRedirects(resp, '/wiki/test/')
+
+    def test_merge(self):
+        ''' test that non-overlapping concurrent edits are merged '''
+        self.login_as_user()
+        self._post('ONE\ntwo\nthree\n', 3)
+        resp = self._post('one\ntwo\nTHREE\n', 3)
+        self.assertRedirects(resp, '/wiki/test/')
+        article = Article.objects.get(pk=self.test_article.pk)
+        self.assertEquals(article.current_version.body.raw,
+                          'ONE\ntwo\nTHREE\n')
+
+    def test_conflict(self):
+        ''' test that overlapping concurrent edits are sent back '''
+        self.login_as_user()
+        self._post('one\n2\nthree\n', 3)
+        resp = self._post('one\nTWO\nthree\n', 3)
+        self.assertContains(resp, '&lt;&lt;&lt;&lt;&lt;&lt;&lt; your changes')
+        self.assertEquals(Article.objects.get(pk=self.test_article.pk)
+                          .latest_number, 4)
+
+    def test_missing_base(self):
+        ''' test that edits of a deleted version are sent back as conflicts '''
+        self.login_as_user()
+        self._post('one\n2\nthree\n', 3)
+        self.test_article.versions.filter(number=3).delete()
+        resp = self._post('one\nTWO\nthree\n', 3)
+        self.assertContains(resp, 'one\nTWO\nthree')
+        self.assertEquals(Article.objects.get(pk=self.test_article.pk)
+                          .latest_number, 4)
+
+
+class InstrumentationTests(TestCase):
+
+    def test_timed_disabled(self):
+        ''' test that timed leaves functions alone when disabled '''
+        func = lambda: None
+        self.assertTrue(instrumentation.timed('x')(func) is func)
+
+    def test_server_timing(self):
+        ''' test the Server-Timing header format '''
+        timings = instrumentation.RequestTimings('view_article')
+        timings.add('sql', 0.002)
+        timings.add('template', 0.001)
+        timings.queries = 3
+        self.assertEquals(timings.server_timing(),
+                          'sql;dur=2.00;desc="3 queries", template;dur=1.00')
+
+
+class InstrumentationMiddlewareTests(ViewTestsBase):
+
+    def setUp(self):
+        super(InstrumentationMiddlewareTests, self).setUp()
+        self.enabled = instrumentation.ENABLED
+        instrumentation.ENABLED = True
+        self.sinks = instrumentation._sinks
+        instrumentation._sinks = [instrumentation.RingBufferSink()]
+
+    def tearDown(self):
+        instrumentation.ENABLED = self.enabled
+        instrumentation._sinks = self.sinks
+        instrumentation.set_timings(None)
+
+    def test_server_timing_header(self):
+        ''' test that markupwiki views are timed by the middleware '''
+        middleware = list(settings.MIDDLEWARE_CLASSES) + [
+            'markupwiki.instrumentation.InstrumentationMiddleware']
+        with self.settings(MIDDLEWARE_CLASSES=middleware):
+            resp = self.client.get('/wiki/test/')
+        self.assertTrue('total;dur=' in resp['Server-Timing'])
+        self.assertTrue('queries' in resp['Server-Timing'])
+        self.assertEquals(instrumentation.get_timings(), None)
+
+    def test_exception_stops_timing(self):
+        ''' test that a view raising leaves no timings behind '''
+        middleware = instrumentation.InstrumentationMiddleware()
+        request = RequestFactory().get('/wiki/test/')
+        middleware.process_request(request)
+        middleware.process_view(request, views.view_article, (),
+                                {'title': 'test'})
+        self.assertNotEqual(instrumentation.get_timings(), None)
+        middleware.process_exception(request, ValueError())
+        self.assertEquals(instrumentation.get_timings(), None)
+
+    def test_worker_timings(self):
+        ''' test that functions run by workers add to the request's timings '''
+        timings = instrumentation.RequestTimings('view_article')
+        instrumentation.set_timings(timings)
+        def slow():
+            time.sleep(0.01)
+        workers.run(instrumentation.timed('diff')(slow))
+        self.assertTrue(timings.phases['diff'] >= 0.01)
+
+
+class ExportImportTests(ViewTestsBase):
+
+    def test_roundtrip(self):
+        ''' test that an exported wiki can be imported into an empty one '''
+        fd, filename = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+        out = StringIO()
+        try:
+            call_command('exportwiki', filename, stdout=out)
+            Article.objects.all().delete()
+            call_command('importwiki', filename, stdout=out)
+        finally:
+            os.remove(filename)
+        self.assertTrue('imported 3 articles, skipped 0 existing' in
+                        out.getvalue())
+
+        article = Article.objects.get(title='test')
+        self.assertEquals(article.latest_number, 2)
+        self.assertEquals(article.current_version.body.raw,
+                          'this is the final update')
+        self.assertTrue('final update' in article.current_version.body.rendered)
+        old = article.versions.get(number=1)
+        self.assertEquals(old.author, self.frank)
+        self.assertEquals(old.restore_body().raw, 'this is an update')
+        self.assertTrue('an update' in old.body.rendered)
+
+
+class RerenderTests(ViewTestsBase):
+
+    def test_rerender(self):
+        ''' test that rerenderwiki renders every version again '''
+        ArticleVersion.objects.all().update(_body_rendered='stale')
+        out = StringIO()
+        call_command('rerenderwiki', processes=1, stdout=out)
+        self.assertTrue('re-rendered 5 versions' in out.getvalue())
+        for version in ArticleVersion.objects.all():
+            self.assertNotEquals(version.body.rendered, 'stale')
+        self.assertTrue('final update' in
+                        Article.objects.get(title='test').current_version.body.rendered)
+
+    def test_head_only(self):
+        ''' test that --head-only only renders the latest versions '''
+        ArticleVersion.objects.all().update(_body_rendered='stale')
+        out = StringIO()
+        call_command('rerenderwiki', processes=1, head_only=True, stdout=out)
+        self.assertTrue('re-rendered 3 versions' in out.getvalue())
+        article = Article.objects.get(title='test')
+        self.assertTrue('final update' in
+                        article.current_version.body.rendered)
+        self.assertEquals(article.versions.get(number=0).body.rendered,
+                          'stale')
+
+
+class RecentChangesTests(ViewTestsBase):
+
+    def test_line_counts(self):
+        ''' test that versions record the lines they added and removed '''
+        version = self.test_article.versions.get(number=1)
+        self.assertEquals((version.lines_added, version.lines_removed), (1, 1))
+        version = self.test_article.versions.get(number=0)
+        self.assertEquals((version.lines_added, version.lines_removed), (1, 0))
+
+    def test_description(self):
+        ''' test that feeds describe changes instead of including bodies '''
+        resp = self.client.get('/wiki/rss/')
+        self.assertContains(resp, '+1 -1 lines by frank')
+        self.assertNotContains(resp, 'this is the final update')
+
+    def test_filters(self):
+        ''' test the author and status feed filters '''
+        resp = self.client.get('/wiki/rss/', {'author': 'frank'})
+        self.assertContains(resp, 'test rev #1')
+        self.assertNotContains(resp, 'test rev #0')
+
+        resp = self.client.get('/wiki/rss/', {'status': 'locked'})
+        self.assertContains(resp, 'locked rev #0')
+        self.assertNotContains(resp, 'two_words')
+
+        resp = self.client.get('/wiki/rss/', {'status': 'bogus'})
+        self.assertEquals(resp.status_code, 404)
+
+    def test_section_filter(self):
+        ''' test that the section filter includes nested sections '''
+        article = Article.objects.create(title='section/page',
+                                         creator=self.admin)
+        ArticleVersion.objects.create(article=article, author=self.admin,
+                                      number=0, body='in a section')
+        nested = Article.objects.create(title='section/sub/page',
+                                        creator=self.admin)
+        ArticleVersion.objects.create(article=nested, author=self.admin,
+                                      number=0, body='in a subsection')
+        resp = self.client.get('/wiki/rss/', {'section': 'section'})
+        self.assertContains(resp, 'section/page rev #0')
+        self.assertContains(resp, 'section/sub/page rev #0')
+        self.assertNotContains(resp, 'two_words')
+
+    def test_feed_cached(self):
+        ''' test that the feed is cached until a new version is written '''
+        first = self.client.get('/wiki/rss/')
+        # only the ETag is looked up when the feed is cached
+        with self.assertNumQueries(2):
+            second = self.client.get('/wiki/rss/')
+        self.assertEquals(first.content, second.content)
+
+        # a new version changes the ETag so the feed is rebuilt
+        ArticleVersion.objects.create(article=self.test_article,
+                                      author=self.admin, number=3,
+                                      body='a brand new version')
+        resp = self.client.get('/wiki/rss/')
+        self.assertContains(resp, 'test rev #3')
+
+    def test_status_change_refreshes_feed(self):
+        ''' test that a status change without a new version changes the
+            filtered feed '''
+        resp = self.client.get('/wiki/rss/', {'status': 'locked'})
+        self.assertNotContains(resp, 'test rev #2')
+        article = Article.objects.get(title='test')
+        article.status = LOCKED
+        article.save()
+        resp = self.client.get('/wiki/rss/', {'status': 'locked'})
+        self.assertContains(resp, 'test rev #2')
+
+
+class SectionTests(ViewTestsBase):
+
+    def test_section_fields(self):
+        ''' test that the section is stored from the title '''
+        article = Article.objects.create(title='A/b/c', creator=self.admin)
+        self.assertEquals(article.section, 'a/b')
+        self.assertEquals(self.test_article.section, '')
+
+    def test_rename_moves_section(self):
+        ''' test that renaming an article moves it to the new section '''
+        article = Article.objects.create(title='a/page', creator=self.admin)
+        self.login_as_admin()
+        self.client.post('/wiki/a/page/rename_article/',
+                         {'new_title': 'b/page'})
+        article = Article.objects.get(pk=article.pk)
+        self.assertEquals(article.section, 'b')
+
+    def test_section_index(self):
+        ''' test that the section index lists direct children only '''
+        for title in ('sec/one', 'sec/two', 'sec/two/sub', 'other/three'):
+            Article.objects.create(title=title, creator=self.admin)
+        resp = self.client.get('/wiki/sec/children/')
+        self.assertEquals(resp.context['count'], 2)
+        self.assertEquals([(a.title, a.child_count)
+                           for a in resp.context['articles']],
+                          [('sec/one', 0), ('sec/two', 1)])
+
+    def test_section_index_case(self):
+        ''' test that sections are matched ignoring case like titles '''
+        Article.objects.create(title='Foo/one', creator=self.admin)
+        Article.objects.create(title='foo/two', creator=self.admin)
+        Article.objects.create(title='FOO/two/sub', creator=self.admin)
+        resp = self.client.get('/wiki/foo/children/')
+        self.assertEquals([(a.title, a.child_count)
+                           for a in resp.context['articles']],
+                          [('Foo/one', 0), ('foo/two', 1)])
+
+    def test_section_index_paging(self):
+        ''' test that the section index is paged by title '''
+        for title in ('sec/one', 'sec/two', 'sec/three'):
+            Article.objects.create(title=title, creator=self.admin)
+        old, views.SECTION_PAGE_SIZE = views.SECTION_PAGE_SIZE, 2
+        try:
+            resp = self.client.get('/wiki/sec/children/')
+            self.assertEquals(resp.context['next_after'], 'sec/three')
+            resp = self.client.get('/wiki/sec/children/',
+                                   {'after': 'sec/three'})
+            self.assertEquals([a.title for a in resp.context['articles']],
+                              ['sec/two'])
+            self.assertEquals(resp.context['next_after'], None)
+        finally:
+            views.SECTION_PAGE_SIZE = old
+
+
+class SectionRenderTests(TestCase):
+
+    text = 'intro\n# One\nfirst\n## Two\nsecond\n'
+
+    def setUp(self):
+        cache.clear()
+        self.rendered = []
+        self.min_size = sections.SECTION_RENDER_MIN_SIZE
+        sections.SECTION_RENDER_MIN_SIZE = 0
+
+    def tearDown(self):
+        sections.SECTION_RENDER_MIN_SIZE = self.min_size
+
+    def render(self, text):
+        self.rendered.append(text)
+        return text.upper().strip()
+
+    def test_split(self):
+        ''' test splitting and replacing sections '''
+        parts = sections.split_sections(self.text)
+        self.assertEquals(parts, ['intro\n', '# One\nfirst\n',
+                                  '## Two\nsecond\n'])
+        self.assertEquals(sections.replace_section(self.text, 1, '# 1'),
+                          'intro\n# 1\n## Two\nsecond\n')
+        self.assertRaises(IndexError, sections.replace_section, self.text, 3,
+                          'x')
+
+    def test_only_changed_sections_rendered(self):
+        ''' test that only changed sections are rendered again '''
+        render = sections.section_markup_wrapper('markdown', self.render)
+        self.assertEquals(render(self.text),
+                          'INTRO\n# ONE\nFIRST\n## TWO\nSECOND')
+        self.assertEquals(len(self.rendered), 3)
+        render(self.text.replace('second', 'changed'))
+        self.assertEquals(self.rendered[3:], ['## Two\nchanged\n'])
+
+    def test_spanning_rendered_whole(self):
+        ''' test that text with fences spanning headings is rendered whole '''
+        render = sections.section_markup_wrapper('markdown', self.render)
+        text = self.text + '```\n# not a heading\n```\n'
+        render(text)
+        self.assertEquals(self.rendered, [text])
+
+
+class SectionEditTests(ViewTestsBase):
+
+    def setUp(self):
+        super(SectionEditTests, self).setUp()
+        ArticleVersion.objects.create(article=self.test_article,
+                                      author=self.admin, number=3,
+                                      body='# One\nfirst\n# Two\nsecond\n')
+
+    def test_edit_section(self):
+        ''' test that a single section can be edited '''
+        self.login_as_user()
+        resp = self.client.get('/wiki/test/edit/', {'section': 1})
+        self.assertEquals(resp.context['form']['body'].value(),
+                          '# Two\nsecond\n')
+        resp = self.client.post('/wiki/test/edit/',
+                                {'body': '# Two\nchanged', 'comment': '',
+                                 'body_markup_type': 'markdown',
+                                 'base_revision': 3, 'section': 1})
+        self.assertRedirects(resp, '/wiki/test/')
+        article = Article.objects.get(pk=self.test_article.pk)
+        self.assertEquals(article.current_version.body.raw,
+                          '# One\nfirst\n# Two\nchanged')
+
+    def test_missing_section(self):
+        ''' test that editing a missing section is a 404 '''
+        self.login_as_user()
+        resp = self.client.get('/wiki/test/edit/', {'section': 5})
+        self.assertEquals(resp.status_code, 404)
+
+
+class AutolockTests(ViewTestsBase):
+
+    def setUp(self):
+        super(AutolockTests, self).setUp()
+        Article.objects.filter(title='test').update(
+            created=datetime.datetime.now() - datetime.timedelta(days=10))
+
+    def test_age(self):
+        ''' test that old articles are locked '''
+        before = Article.objects.get(title='test').modified
+        with self.settings(MARKUPWIKI_AUTOLOCK_TIMEDELTA=
+                           datetime.timedelta(days=5)):
+            call_command('autolockarticles', stdout=StringIO())
+        self.assertEquals(Article.objects.get(title='test').status, LOCKED)
+        # the feeds' ETags depend on modified
+        self.assertTrue(Article.objects.get(title='test').modified > before)
+        self.assertEquals(Article.objects.get(title='two_words').status,
+                          PUBLIC)
+
+    def test_edit_count(self):
+        ''' test that articles with enough edits are locked '''
+        with self.settings(MARKUPWIKI_AUTOLOCK_EDIT_COUNT=3):
+            call_command('autolockarticles', stdout=StringIO())
+        self.assertEquals(Article.objects.get(title='test').status, LOCKED)
+        self.assertEquals(Article.objects.get(title='two_words').status,
+                          PUBLIC)
+
+    def test_inactivity(self):
+        ''' test that articles not edited for a while are locked '''
+        Article.objects.filter(title='test').update(
+            modified=datetime.datetime.now() - datetime.timedelta(days=10))
+        with self.settings(MARKUPWIKI_AUTOLOCK_INACTIVITY=
+                           datetime.timedelta(days=5)):
+            call_command('autolockarticles', stdout=StringIO())
+        self.assertEquals(Article.objects.get(title='test').status, LOCKED)
+        self.assertEquals(Article.objects.get(title='two_words').status,
+                          PUBLIC)
+
+    def test_dry_run(self):
+        ''' test that --dry-run locks nothing '''
+        with self.settings(MARKUPWIKI_AUTOLOCK_TIMEDELTA=
+                           datetime.timedelta(days=5)):
+            out = StringIO()
+            call_command('autolockarticles', dry_run=True, stdout=out)
+        self.assertEquals(out.getvalue(), 'age: 1 articles would be locked\n')
+        self.assertEquals(Article.objects.get(title='test').status, PUBLIC)
+
+
+class TitleKeyTests(ViewTestsBase):
+
+    def test_canonicalize(self):
+        ''' test that titles differing in case or spacing share a key '''
+        self.assertEquals(canonicalize_title(' a  b__c '), 'a_b_c')
+        self.assertEquals(canonicalize_title('section _/ page'),
+                          'section/page')
+        self.assertEquals(title_key('Foo_Bar'), title_key('foo bar'))
+
+    def test_case_insensitive_lookup(self):
+        ''' test that other spellings redirect to the article '''
+        resp = self.client.get('/wiki/TEST/')
+        self.assertRedirects(resp, '/wiki/test/', status_code=301)
+        resp = self.client.get('/wiki/Two__Words/')
+        self.assertRedirects(resp, '/wiki/Two_Words/', status_code=301,
+                             target_status_code=301)
+
+    def test_edit_existing_spelling(self):
+        ''' test that editing another spelling edits the existing article '''
+        self.login_as_user()
+        self.client.post('/wiki/TEST/edit/', {'body': 'new body',
+                                              'body_markup_type': 'markdown'})
+        self.assertEquals(Article.objects.filter(title_key='test').count(), 1)
+        self.assertEquals(Article.objects.get(title='test').latest_number, 3)
+
+    def test_rename_case(self):
+        ''' test that a rename changing only case leaves no redirect '''
+        self.login_as_admin()
+        resp = self.client.post('/wiki/test/rename_article/',
+                                {'new_title': 'Test'})
+        self.assertRedirects(resp, '/wiki/Test/')
+        self.assertEquals(Article.objects.get(title_key='test').title, 'Test')
+        self.assertEquals(Article.objects.count(), 3)
+
+    def test_links_match_key(self):
+        ''' test that links are matched on the title key '''
+        article = Article.objects.create(title='linker', creator=self.admin)
+        ArticleVersion.objects.create(article=article, author=self.admin,
+                                      number=0, body='see [[TEST]]')
+        self.assertEquals(list(self.test_article.get_backlinks()), [article])
+
+    def test_backfill_renames_clashes(self):
+        ''' test that backfillarticles renames titles whose key is taken '''
+        article = Article.objects.create(title='other', creator=self.admin)
+        Article.objects.filter(pk=article.pk).update(title='Test',
+                                                     title_key=None)
+        out = StringIO()
+        call_command('backfillarticles', stdout=out)
+        self.assertTrue('renamed Test to Test_2' in out.getvalue())
+        article = Article.objects.get(pk=article.pk)
+        self.assertEquals((article.title, article.title_key),
+                          ('Test_2', 'test_2'))
+        self.assertEquals(Article.objects.get(title_key='test'),
+                          self.test_article)
+
+
+class PreviewTests(ViewTestsBase):
+
+    def _preview(self, body):
+        return self.client.post('/wiki/test/preview/',
+                                {'body': body, 'body_markup_type': 'markdown'})
+
+    def test_preview(self):
+        ''' test that previews are rendered without saving a version '''
+        self.login_as_user()
+        resp = self._preview('a preview of [[two words]]')
+        self.assertContains(resp, 'a preview of')
+        self.assertContains(resp, 'href="/wiki/two_words/"')
+        self.assertEquals(ArticleVersion.objects.count(), 5)
+
+    def test_preview_requires_editor(self):
+        ''' test that previews need an editor '''
+        resp = self._preview('anonymous')
+        self.assertEquals(resp.status_code, 302)
+
+    def test_preview_limits(self):
+        ''' test the preview size limit and markup type check '''
+        self.login_as_user()
+        old, views.PREVIEW_MAX_SIZE = views.PREVIEW_MAX_SIZE, 10
+        try:
+            resp = self._preview('x' * 11)
+        finally:
+            views.PREVIEW_MAX_SIZE = old
+        self.assertEquals(resp.status_code, 413)
+
+        resp = self.client.post('/wiki/test/preview/',
+                                {'body': 'x', 'body_markup_type': 'bogus'})
+        self.assertEquals(resp.status_code, 400)
+
+
+class CompactTests(ViewTestsBase):
+
+    def setUp(self):
+        self.revision_storage = storage.REVISION_STORAGE
+        storage.REVISION_STORAGE = 'delta'
+        super(CompactTests, self).setUp()
+
+    def tearDown(self):
+        storage.REVISION_STORAGE = self.revision_storage
+
+    def numbers(self):
+        return list(self.test_article.versions.order_by('number')
+                    .values_list('number', flat=True))
+
+    def test_squash(self):
+        ''' test that quick edits by the same author are squashed '''
+        call_command('compactwiki', squash_window=60, stdout=StringIO())
+        self.assertEquals(self.numbers(), [0, 2])
+        self.assertEquals(Article.objects.get(title='test').get_latest_version()
+                          .body.raw, 'this is the final update')
+
+    def test_keep_last(self):
+        ''' test that --keep-last keeps the newest versions '''
+        call_command('compactwiki', squash_window=60, keep_last=2,
+                     stdout=StringIO())
+        self.assertEquals(self.numbers(), [0, 1, 2])
+        call_command('compactwiki', keep_last=1, stdout=StringIO())
+        self.assertEquals(self.numbers(), [2])
+        self.assertEquals(self.two_word_article.versions.count(), 1)
+
+    def test_dry_run(self):
+        ''' test that --dry-run deletes nothing '''
+        out = StringIO()
+        call_command('compactwiki', keep_last=1, dry_run=True, stdout=out)
+        self.assertEquals(self.numbers(), [0, 1, 2])
+        self.assertTrue('dry run: 2 versions deleted' in out.getvalue())
+
+    def test_removed_rewrites_delta(self):
+        ''' test that deltas based on deleted versions are re-encoded '''
+        for number, body in ((3, 'a third update'), (4, 'the last update')):
+            ArticleVersion.objects.create(article=self.test_article,
+                                          author=self.admin, number=number,
+                                          body=body)
+        self.test_article.versions.filter(number=3).update(removed=True)
+        call_command('compactwiki', stdout=StringIO())
+        self.assertEquals(self.numbers(), [0, 1, 2, 4])
+        versions = dict((v.number, v) for v in self.test_article.versions.all())
+        self.assertNotEquals(versions[2].body_delta, '')
+        self.assertEquals(versions[2].restore_body().raw,
+                          'this is the final update')
+        self.assertEquals(versions[1].restore_body().raw, 'this is an update')
+
+
+class RateLimitTests(ViewTestsBase):
+
+    def setUp(self):
+        super(RateLimitTests, self).setUp()
+        self.limits = (ratelimit.EDITOR_RATE_LIMIT,
+                       ratelimit.MODERATOR_RATE_LIMIT)
+        ratelimit.EDITOR_RATE_LIMIT = 2
+        ratelimit.MODERATOR_RATE_LIMIT = 3
+
+    def tearDown(self):
+        (ratelimit.EDITOR_RATE_LIMIT,
+         ratelimit.MODERATOR_RATE_LIMIT) = self.limits
+
+    def edit(self, n):
+        return self.client.post('/wiki/test/edit/',
+                                {'body': 'edit %s' % n,
+                                 'body_markup_type': 'markdown'})
+
+    def test_editor_limit(self):
+        ''' test that editors are limited and GETs aren't counted '''
+        self.login_as_user()
+        for n in range(2):
+            self.assertRedirects(self.edit(n), '/wiki/test/')
+        resp = self.edit(2)
+        self.assertEquals(resp.status_code, 429)
+        self.assertEquals(self.test_article.versions.count(), 5)
+        # GETs aren't counted
+        self.assertEquals(self.client.get('/wiki/test/edit/').status_code, 200)
+
+    def test_moderator_limit(self):
+        ''' test that moderators get the higher limit '''
+        self.login_as_admin()
+        for n in range(3):
+            self.assertRedirects(self.edit(n), '/wiki/test/')
+        resp = self.client.post('/wiki/test/revert/', {'revision': 0})
+        self.assertEquals(resp.status_code, 429)
+
+    def test_anonymous_by_ip(self):
+        ''' test that anonymous users are limited by IP address '''
+        factory = RequestFactory()
+        request = factory.post('/', REMOTE_ADDR='10.0.0.1')
+        request.user = AnonymousUser()
+        self.assertTrue(ratelimit.hit(request))
+        self.assertTrue(ratelimit.hit(request))
+        self.assertFalse(ratelimit.hit(request))
+        request.META['REMOTE_ADDR'] = '10.0.0.2'
+        self.assertTrue(ratelimit.hit(request))
+
+
+class ConfTests(TestCase):
+
+    def test_settings_change(self):
+        ''' test that render_markup follows changed settings '''
+        with self.settings(MARKUPWIKI_ESCAPE_HTML=False):
+            self.assertEquals(models.render_markup('<b>x</b>', 'html', False),
+                              '<b>x</b>')
+        self.assertEquals(models.render_markup('<b>x</b>', 'html', False),
+                          '&lt;b&gt;x&lt;/b&gt;')
+
+    def test_dotted_path(self):
+        ''' test that markup functions can be given as dotted paths '''
+        with self.settings(MARKUPWIKI_MARKUP_TYPES=[('html', 'string.upper')]):
+            self.assertEquals(models.render_markup('abc', 'html', False),
+                              'ABC')
+
+
 class RenameTests(ViewTestsBase):
 
     def test_rename(self):
@@ -327,3 +1350,75 @@ class RenameTests(ViewTestsBase):
         # check that redirect points to three
         two = Article.objects.get(title='two_words')
         self.assertEquals(two.redirect_to, three)
+
+    def test_rename_back(self):
+        ''' test that renaming onto a redirect replaces the redirect '''
+        self.login_as_admin()
+        self.client.post('/wiki/two_words/rename_article/',
+                         {'new_title': 'renamed'})
+        resp = self.client.post('/wiki/renamed/rename_article/',
+                                {'new_title': 'two_words'})
+        self.assertRedirects(resp, '/wiki/two_words/')
+        two = Article.objects.get(title='two_words')
+        self.assertEquals(two.redirect_to, None)
+        self.assertEquals(Article.objects.get(title='renamed').redirect_to,
+                          two)
+
+    def test_rename_onto_article(self):
+        ''' test that renaming onto an existing article is refused '''
+        self.login_as_admin()
+        self.client.post('/wiki/two_words/rename_article/',
+                         {'new_title': 'test'})
+        self.assertEquals(Article.objects.filter(title='test').count(), 1)
+        self.assertEquals(Article.objects.get(title='two_words').redirect_to,
+                          None)
+
+    def test_collapse_chain(self):
+        ''' test that redirects to an article that becomes a redirect are
+            pointed at the final target '''
+        stub = Article.objects.create(title='stub',
+                                      redirect_to=self.two_word_article)
+        self.two_word_article.redirect_to = self.test_article
+        self.two_word_article.save()
+        self.assertEquals(Article.objects.get(pk=stub.pk).redirect_to,
+                          self.test_article)
+
+        # a new redirect to a redirect points at the final target
+        other = Article.objects.create(title='other',
+                                       redirect_to=self.two_word_article)
+        self.assertEquals(other.redirect_to, self.test_article)
+
+    def test_redirect_loop(self):
+        ''' test that saving a redirect loop is refused '''
+        Article.objects.create(title='stub', redirect_to=self.test_article)
+        self.test_article.redirect_to = Article.objects.get(title='stub')
+        self.assertRaises(RedirectLoop, self.test_article.save)
+        self.assertRaises(ValidationError, self.test_article.full_clean)
+
+    def test_missing_redirect_target(self):
+        ''' test that redirects to a deleted article are not followed '''
+        Article.objects.filter(pk=self.two_word_article.pk).update(
+            redirect_to=self.test_article.pk + 1000)
+        resp = self.client.get('/wiki/two_words/')
+        self.assertEquals(resp.status_code, 404)
+
+        self.login_as_admin()
+        resp = self.client.post('/wiki/two_words/rename_article/',
+                                {'new_title': 'renamed'})
+        self.assertRedirects(resp, '/wiki/two_words/', target_status_code=404)
+        self.assertFalse(Article.objects.filter(title='renamed').exists())
+
+    def test_cached_redirect(self):
+        ''' test that redirects are served from the cache '''
+        Article.objects.create(title='stub', redirect_to=self.test_article)
+        resp = self.client.get('/wiki/stub/')
+        self.assertRedirects(resp, '/wiki/test/')
+        with self.assertNumQueries(0):
+            self.client.get('/wiki/stub/')
+
+        # renaming the target updates the cached redirect
+        self.login_as_admin()
+        self.client.post('/wiki/test/rename_article/', {'new_title': 'moved'})
+        self.client.logout()
+        resp = self.client.get('/wiki/stub/')
+        self.assertRedirects(resp, '/wiki/moved/')
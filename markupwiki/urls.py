@@ -1,17 +1,27 @@
 from django.conf.urls import *
-from markupwiki.feeds import LatestEditsFeed, LatestArticleEditsFeed
 
 WIKI_REGEX = r'^(?P<title>.+)'
 
-urlpatterns = patterns('markupwiki.views',
-    url('^rss/$', LatestEditsFeed(), name='wiki_rss'),
-    url(WIKI_REGEX + '/rss/$', LatestArticleEditsFeed(), name='article_rss'),
+# views are named by string so importing the urlconf doesn't import the
+# views, feeds and syndication framework, django imports them the first time
+# a url is resolved or reversed
+urlpatterns = patterns('markupwiki.feeds',
+    url('^rss/$', 'latest_edits', name='wiki_rss'),
+    url(WIKI_REGEX + '/rss/$', 'latest_article_edits', name='article_rss'),
+)
+
+urlpatterns += patterns('markupwiki.views',
+    url('^search/$', 'search', name='wiki_search'),
     url(WIKI_REGEX + '/edit/$', 'edit_article', name='edit_article'),
+    url(WIKI_REGEX + '/preview/$', 'preview', name='preview_article'),
     url(WIKI_REGEX + '/update_status/$', 'article_status', name='update_article_status'),
     url(WIKI_REGEX + '/rename_article/$', 'rename', name='rename_article'),
     url(WIKI_REGEX + '/history/$', 'article_history', name='article_history'),
+    url(WIKI_REGEX + '/history/json/$', 'article_history_json', name='article_history_json'),
     url(WIKI_REGEX + '/history/(?P<n>\d+)/$', 'view_article', name='article_version'),
     url(WIKI_REGEX + '/diff/$', 'article_diff', name='article_diff'),
     url(WIKI_REGEX + '/revert/$', 'revert', name='revert'),
+    url(WIKI_REGEX + '/links/$', 'article_backlinks', name='article_backlinks'),
+    url(WIKI_REGEX + '/children/$', 'section_index', name='section_index'),
     url(WIKI_REGEX + '/$', 'view_article', name='view_article'),
 )
@@ -3,23 +3,186 @@
 '''
 
 import re
-from django.core.urlresolvers import reverse
+import unicodedata
+from difflib import SequenceMatcher
+from django.conf import settings
+from django.core.urlresolvers import reverse, get_urlconf, get_script_prefix
+from django.utils.http import urlquote
+from markupwiki.instrumentation import timed
+
+RESOLVE_LINKS = getattr(settings, 'MARKUPWIKI_RESOLVE_LINKS', False)
 
 link_re = re.compile('\[\[(?P<link>.*?)(?:\|(?P<name>.*?))?\]\]')
+title_space_re = re.compile(r'[\s_]+', re.UNICODE)
+title_slash_re = re.compile(r'_*/_*')
+
+_LINK_PLACEHOLDER = 'markupwikilinkplaceholder'
+_url_templates = {}
+
+def _get_url_template():
+    ''' return (prefix, suffix) surrounding the title in view_article urls
+
+        reverse() is only called once per urlconf, after that building a link
+        is just quoting the title
+    '''
+    # get_urlconf() is None unless a request set one, ROOT_URLCONF applies
+    key = (get_urlconf() or settings.ROOT_URLCONF, get_script_prefix())
+    template = _url_templates.get(key)
+    if template is None:
+        url = reverse('view_article', args=[_LINK_PLACEHOLDER])
+        template = tuple(url.split(_LINK_PLACEHOLDER, 1))
+        _url_templates[key] = template
+    return template
+
+def article_url(title):
+    ''' equivalent to reverse('view_article', args=[title]) '''
+    prefix, suffix = _get_url_template()
+    return ''.join((prefix, urlquote(title), suffix))
+
+def canonicalize_title(title):
+    ''' return the form of title articles are stored under: runs of spaces
+        and underscores become a single underscore and underscores at either
+        end of the title or of a section are dropped '''
+    if isinstance(title, unicode):
+        title = unicodedata.normalize('NFC', title)
+    title = title_space_re.sub('_', title)
+    return title_slash_re.sub('/', title).strip('_')
+
+def title_key(title):
+    ''' return the key titles are matched on, titles that only differ in
+        case, spacing or unicode normalization share a key '''
+    return canonicalize_title(title).lower()
+
+def title_section(title):
+    ''' return the key of the section title is in, eg. 'a/b' for 'A/b/c'
+        ('' at the top level) '''
+    key = title_key(title)
+    if '/' not in key:
+        return ''
+    return key.rsplit('/', 1)[0]
+
+def extract_links(text):
+    ''' return the set of (canonical) article titles linked to from text '''
+    return set(canonicalize_title(m.group('link'))
+               for m in link_re.finditer(text))
+
+def resolve_links(titles):
+    ''' look up a set of link targets with a single query
+
+        returns a dict mapping each title that exists to the title that
+        should be linked to (the redirect target for redirects)
+    '''
+    from markupwiki.models import Article
+    if not titles:
+        return {}
+    keys = set(title_key(title) for title in titles)
+    found = {}
+    for key, title, target in Article.objects.filter(
+            title_key__in=keys).values_list('title_key', 'title',
+                                            'redirect_to__title'):
+        found[key] = target or title
+    return dict((title, found[title_key(title)]) for title in titles
+                if title_key(title) in found)
 
-def _link_repl_func(match_obj):
-    gd = match_obj.groupdict()
-    name = gd['name'] or gd['link']
-    name = name.strip()
-    link = reverse('view_article', args=[gd['link'].strip()])
-    return '<a href="%s">%s</a>' % (link, name)
+@timed('links')
+def make_wiki_links(text, resolve=None):
+    ''' replace [[link]] and [[link|name]] with html links
 
-def make_wiki_links(text):
-    return link_re.sub(_link_repl_func, text)
+        if resolve is True (defaults to MARKUPWIKI_RESOLVE_LINKS) links to
+        redirects point at the redirect target and links to missing articles
+        get class="missing"
+    '''
+    if resolve is None:
+        resolve = RESOLVE_LINKS
+
+    if resolve:
+        resolved = resolve_links(extract_links(text))
+
+    def repl(match_obj):
+        gd = match_obj.groupdict()
+        name = gd['name'] or gd['link']
+        name = name.strip()
+        link = canonicalize_title(gd['link'])
+        if not resolve:
+            return '<a href="%s">%s</a>' % (article_url(link), name)
+        elif link in resolved:
+            return '<a href="%s">%s</a>' % (article_url(resolved[link]), name)
+        else:
+            return '<a href="%s" class="missing">%s</a>' % (article_url(link),
+                                                            name)
+
+    return link_re.sub(repl, text)
 
 def wikify_markup_wrapper(f):
     if not hasattr(f, 'wikified_markup'):
-        new_f = lambda text: make_wiki_links(f(text))
+        markup_func = timed('markup')(f)
+        new_f = lambda text: make_wiki_links(markup_func(text))
         new_f.wikified_markup = True
         return new_f
     return f
+
+def _hunks(base_lines, lines):
+    matcher = SequenceMatcher(None, base_lines, lines, autojunk=False)
+    return [(i1, i2, lines[j1:j2])
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+def _apply_hunks(base_lines, start, end, hunks):
+    result = []
+    pos = start
+    for i1, i2, lines in hunks:
+        result.extend(base_lines[pos:i1])
+        result.extend(lines)
+        pos = i2
+    result.extend(base_lines[pos:end])
+    return result
+
+def _terminated(lines):
+    if lines and not lines[-1].endswith('\n'):
+        lines = lines[:-1] + [lines[-1] + '\n']
+    return lines
+
+def merge3(base, mine, theirs):
+    ''' line based three way merge of two texts derived from base
+
+        returns (merged_text, conflicted), if conflicted is True merged_text
+        contains conflict markers around the lines changed by both sides
+    '''
+    base_lines = base.splitlines(True)
+    changes = sorted([(h, 0) for h in _hunks(base_lines, mine.splitlines(True))] +
+                     [(h, 1) for h in _hunks(base_lines, theirs.splitlines(True))],
+                     key=lambda c: (c[0][0], c[0][1]))
+
+    result = []
+    conflicted = False
+    pos = 0
+    i = 0
+    while i < len(changes):
+        # group changes from both sides that touch overlapping base lines
+        start, end = changes[i][0][0], changes[i][0][1]
+        group = [changes[i]]
+        i += 1
+        while i < len(changes) and changes[i][0][0] <= end:
+            end = max(end, changes[i][0][1])
+            group.append(changes[i])
+            i += 1
+
+        result.extend(base_lines[pos:start])
+        mine_hunks = [h for h, side in group if side == 0]
+        theirs_hunks = [h for h, side in group if side == 1]
+        mine_lines = _apply_hunks(base_lines, start, end, mine_hunks)
+        theirs_lines = _apply_hunks(base_lines, start, end, theirs_hunks)
+        if not theirs_hunks or mine_lines == theirs_lines:
+            result.extend(mine_lines)
+        elif not mine_hunks:
+            result.extend(theirs_lines)
+        else:
+            conflicted = True
+            result.append('<<<<<<< your changes\n')
+            result.extend(_terminated(mine_lines))
+            result.append('=======\n')
+            result.extend(_terminated(theirs_lines))
+            result.append('>>>>>>> current version\n')
+        pos = end
+
+    result.extend(base_lines[pos:])
+    return ''.join(result), conflicted
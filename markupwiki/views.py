@@ -1,27 +1,55 @@
-from difflib import HtmlDiff
+import hashlib
+import json
 from django.shortcuts import get_object_or_404, render_to_response, redirect
-from django.http import HttpResponseForbidden
+from django.http import (HttpResponse, HttpResponseForbidden,
+                         HttpResponseBadRequest)
 from django.conf import settings
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_POST, condition
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib import messages
 from django.http import Http404
 from django.template import RequestContext
+from django.db.models import Count
+from django.utils.cache import patch_cache_control
 from django.utils.functional import wraps
-from markupwiki.models import Article, ArticleVersion, PUBLIC, DELETED, LOCKED
+from markupwiki.models import (Article, ArticleVersion, EditConflict,
+                               RedirectLoop, PUBLIC, DELETED, LOCKED, atomic, render_markup,
+                               WIKI_MARKUP_TYPES, DEFAULT_MARKUP_TYPE)
 from markupwiki.forms import ArticleForm, StaffModerationForm, ArticleRenameForm
+from markupwiki import rendercache, workers, ratelimit
+from markupwiki.conf import conf
+from markupwiki import search as wiki_search
+from markupwiki.utils import (merge3, canonicalize_title, title_key,
+                              make_wiki_links)
+from markupwiki.sections import (split_sections, replace_section,
+                                 SECTION_MARKUP_TYPES)
+from markupwiki.instrumentation import timed
+from markupwiki.diff import get_version_diff, DIFF_MODES, DEFAULT_DIFF_MODE
+
+render_to_response = timed('template')(render_to_response)
 
 CREATE_MISSING_ARTICLE = getattr(settings,
                                  'MARKUPWIKI_CREATE_MISSING_ARTICLES', True)
 
-EDITOR_TEST_FUNC = getattr(settings, 'MARKUPWIKI_EDITOR_TEST_FUNC',
-                           lambda u: u.is_authenticated())
-MODERATOR_TEST_FUNC = getattr(settings, 'MARKUPWIKI_MODERATOR_TEST_FUNC',
-                              lambda u: u.is_staff)
+EDIT_MODE = getattr(settings, 'MARKUPWIKI_EDIT_MODE', 'lock')
+HISTORY_PAGE_SIZE = getattr(settings, 'MARKUPWIKI_HISTORY_PAGE_SIZE', 50)
+SECTION_PAGE_SIZE = getattr(settings, 'MARKUPWIKI_SECTION_PAGE_SIZE', 100)
+REVISION_CACHE_SECONDS = getattr(settings, 'MARKUPWIKI_REVISION_CACHE_SECONDS',
+                                 60*60*24*30)
+PREVIEW_MAX_SIZE = getattr(settings, 'MARKUPWIKI_PREVIEW_MAX_SIZE', 200000)
+PREVIEW_TIMEOUT = getattr(settings, 'MARKUPWIKI_PREVIEW_TIMEOUT', 5.0)
+
+def is_editor(user):
+    return conf.EDITOR_TEST_FUNC(user)
+
+def is_moderator(user):
+    return conf.MODERATOR_TEST_FUNC(user)
 
 def title_check(view):
     def new_view(request, title, *args, **kwargs):
-        newtitle = title.replace(' ', '_')
+        newtitle = canonicalize_title(title)
+        if not newtitle:
+            raise Http404()
         if newtitle != title:
             return redirect(request.path.replace(title, newtitle),
                             permanent=True)
@@ -29,7 +57,72 @@ def title_check(view):
             return view(request, title, *args, **kwargs)
     return wraps(view)(new_view)
 
+def rate_limited(view):
+    ''' refuse POSTs from users over their MARKUPWIKI_*_RATE_LIMIT with a
+        429, before the view touches the database '''
+    def new_view(request, *args, **kwargs):
+        if request.method == 'POST' and not ratelimit.hit(
+                request, is_moderator(request.user)):
+            response = HttpResponse('too many changes, please wait and try '
+                                    'again', status=429)
+            response['Retry-After'] = ratelimit.RATE_LIMIT_SECONDS
+            return response
+        return view(request, *args, **kwargs)
+    return wraps(view)(new_view)
+
+def _get_article(request, title):
+    ''' return the ``Article`` for title with its head version loaded, or
+        None if it doesn't exist
+
+        the article is served from the render cache when possible and is
+        remembered for the rest of the request
+    '''
+    if getattr(request, '_markupwiki_title', None) != title:
+        article = rendercache.get_head(title)
+        if article is None:
+            try:
+                article = Article.objects.select_related(
+                    'current_version').get(title_key=title_key(title))
+            except Article.DoesNotExist:
+                article = None
+            else:
+                if article.redirect_to_id:
+                    # redirects are cached with their target's title so
+                    # they can be followed without a query
+                    targets = Article.objects.filter(
+                        pk=article.redirect_to_id).values_list(
+                            'title', flat=True)
+                    if not targets:
+                        raise Http404()
+                    article.redirect_title = targets[0]
+                else:
+                    article.get_latest_version()
+                rendercache.set_head(article)
+        request._markupwiki_title = title
+        request._markupwiki_article = article
+    return request._markupwiki_article
+
+def _article_etag(request, title, *args, **kwargs):
+    # pages for logged in users contain per-user content
+    if request.user.is_authenticated():
+        return None
+    article = _get_article(request, title)
+    if article is not None:
+        return '%s-%s-%s-%s' % (article.pk, article.latest_number,
+                                article.status, article.redirect_to_id or 0)
+
+def _article_last_modified(request, title, *args, **kwargs):
+    if request.user.is_authenticated():
+        return None
+    article = _get_article(request, title)
+    if article is not None:
+        return article.modified
+
+conditional_article = condition(etag_func=_article_etag,
+                                last_modified_func=_article_last_modified)
+
 @title_check
+@conditional_article
 def view_article(request, title, n=None):
     ''' view an article (or a specific revision of an article)
 
@@ -40,6 +133,7 @@ def view_article(request, title, n=None):
     Context:
         article     - ``Article`` instance
         version     - ``ArticleVersion`` to display
+        rendered_body - rendered body of ``version`` (served from cache)
         mod_form    - ``StaffModerationForm`` instance present if user is staff
         rename_form - ``ArticleRenameForm`` instance present if user is staff
 
@@ -47,51 +141,104 @@ def view_article(request, title, n=None):
         article.html - default template used
     '''
 
-    try:
-        article = Article.objects.get(title=title)
-    except Article.DoesNotExist:
+    article = _get_article(request, title)
+
+    if article is None:
         if CREATE_MISSING_ARTICLE:
             return redirect('edit_article', title)
         else:
             raise Http404()
 
+    # titles differing only in case lead to the article's own url
+    if article.title != title:
+        return redirect(request.path.replace(title, article.title, 1),
+                        permanent=True)
+
     if article.redirect_to_id:
-        return redirect(article.redirect_to)
+        return redirect('view_article', article.redirect_title)
 
     if n:
         version = article.versions.get(number=n)
     else:
-        version = article.versions.latest()
+        version = article.get_latest_version()
         version.is_latest = True
 
     # set editable flag on article
     article.editable = article.is_editable_by_user(request.user)
 
-    context = {'article':article, 'version': version}
+    context = {'article':article, 'version': version,
+               'rendered_body': rendercache.get_rendered(version)}
 
     if request.user.is_staff:
         context['mod_form'] = StaffModerationForm(instance=article)
         context['rename_form'] = ArticleRenameForm()
 
-    return render_to_response('markupwiki/article.html', context,
-                              context_instance=RequestContext(request))
+    response = render_to_response('markupwiki/article.html', context,
+                                  context_instance=RequestContext(request))
+
+    # old revisions never change so they can be cached by anyone
+    if n and article.is_public() and not request.user.is_authenticated():
+        patch_cache_control(response, public=True,
+                            max_age=REVISION_CACHE_SECONDS)
+
+    return response
+
+def _add_version_optimistic(request, article, version, base):
+    ''' save version if the article hasn't changed since revision base or if
+        the changes since then can be merged, otherwise return a form for
+        resolving the conflict '''
+    while True:
+        try:
+            article.add_version(version, base_number=base)
+            return None
+        except EditConflict as e:
+            head = e.head
+            try:
+                base_body = article.versions.get(number=base).restore_body().raw
+            except ArticleVersion.DoesNotExist:
+                # the base was compacted away, nothing to merge against
+                merged, conflicted = version.body.raw, True
+            else:
+                merged, conflicted = merge3(base_body, version.body.raw,
+                                            head.restore_body().raw)
+            if conflicted:
+                messages.error(request, 'Someone else edited this page while you were editing it, please resolve the conflicting changes.')
+                return ArticleForm(data={'body': merged,
+                                         'comment': version.comment,
+                                         'body_markup_type':
+                                             version.body_markup_type,
+                                         'base_revision': head.number})
+            version.body = merged
+            base = head.number
 
 @title_check
-@user_passes_test(EDITOR_TEST_FUNC)
+@user_passes_test(is_editor)
+@rate_limited
 def edit_article(request, title):
     ''' edit (or create) an article
 
+        GET parameters:
+            section - number of the section to edit instead of the whole
+                      article (optional, for markup types in
+                      MARKUPWIKI_SECTION_MARKUP_TYPES)
+
         Context:
             title - title of article being edited
             article - article being edited (potentially None)
             form - form to edit article
+            section - number of the section being edited (or None)
+
+        With MARKUPWIKI_EDIT_MODE = 'optimistic' no write lock is taken,
+        instead edits to an article that changed while it was being edited
+        are merged and the form is shown again if the changes conflict.
 
         Templates:
             edit_article.html - Default template for editing the article.
             locked_article.html - Template shown if editing is locked.
     '''
     try:
-        article = Article.objects.get(title=title)
+        article = Article.objects.select_related('current_version').get(
+            title_key=title_key(title))
     except Article.DoesNotExist:
         article = None
 
@@ -99,18 +246,34 @@ def edit_article(request, title):
     if article and not article.is_editable_by_user(request.user):
         return HttpResponseForbidden('not authorized to edit')
 
+    section = request.GET.get('section')
+    if section is not None:
+        if not section.isdigit():
+            raise Http404()
+        section = int(section)
+
     if request.method == 'GET':
         # either get an empty ArticleForm or one based on latest version
         if article:
 
-            if not article.get_write_lock(request.user):
+            if EDIT_MODE == 'lock' and not article.get_write_lock(request.user):
                 # set message and redirect
                 messages.info(request, 'Someone else is currently editing this page, please wait and try again.')
                 return redirect(article)
 
-            version = article.versions.latest()
-            form = ArticleForm(data={'body':version.body,
-                               'body_markup_type':version.body_markup_type})
+            version = article.get_latest_version()
+            body = version.body.raw
+            if section is not None:
+                if version.body_markup_type not in SECTION_MARKUP_TYPES:
+                    raise Http404()
+                try:
+                    body = split_sections(body)[section]
+                except IndexError:
+                    raise Http404()
+            form = ArticleForm(data={'body': body,
+                               'body_markup_type':version.body_markup_type,
+                               'base_revision':version.number,
+                               'section': section})
         else:
             form = ArticleForm()
     elif request.method == 'POST':
@@ -119,97 +282,338 @@ def edit_article(request, title):
         
         if form.is_valid():
             if not article:
-                # if article doesn't exist create it and start num at 0
+                # if article doesn't exist create it
                 article = Article.objects.create(title=title,
                                                  creator=user)
-                num = 0
-            else:
+            elif EDIT_MODE == 'lock':
                 if not article.get_write_lock(request.user):
                     # set message and redirect
                     messages.error(request, 'Your session timed out and someone else is now editing this page.')
                     return redirect(article)
 
-                # otherwise get latest num
-                num = article.versions.latest().number + 1
-
             # create a new version attached to article specified in name
             version = form.save(False)
-            version.article = article
             version.author = user
-            version.number = num
-            version.save()
 
-            article.get_write_lock(user or request, release=True)
+            # a section edit replaces that section of the version it was
+            # based on, the result is saved like an edit of the whole article
+            section = form.cleaned_data['section']
+            if section is not None and article.latest_number >= 0:
+                base = form.cleaned_data['base_revision']
+                if base is None:
+                    base_version = article.get_latest_version()
+                else:
+                    base_version = get_object_or_404(article.versions,
+                                                     number=base)
+                try:
+                    version.body = replace_section(
+                        base_version.restore_body().raw, section,
+                        version.body.raw)
+                except IndexError:
+                    raise Http404()
+
+            if EDIT_MODE == 'optimistic':
+                conflict_form = _add_version_optimistic(
+                    request, article, version,
+                    form.cleaned_data['base_revision'])
+            else:
+                article.add_version(version)
+                article.get_write_lock(user or request, release=True)
+                conflict_form = None
 
-            # redirect to view article on save
-            return redirect(article)
+            if conflict_form is None:
+                # redirect to view article on save
+                return redirect(article)
+            # conflicts are resolved in the whole article
+            form = conflict_form
+            section = None
 
     return render_to_response('markupwiki/edit_article.html',
-                              {'title':title, 'article':article, 'form': form},
+                              {'title':title, 'article':article, 'form': form,
+                               'section': section},
                               context_instance=RequestContext(request))
 
 
 @require_POST
-@user_passes_test(MODERATOR_TEST_FUNC)
+@user_passes_test(is_editor)
+@title_check
+def preview(request, title):
+    ''' POST-only view returning the html an edit would be rendered to,
+        without saving anything
+
+        POST parameters:
+            body             - markup to render
+            body_markup_type - markup type (optional)
+
+        Bodies longer than MARKUPWIKI_PREVIEW_MAX_SIZE are refused with a 413
+        and a 503 is returned if rendering takes longer than
+        MARKUPWIKI_PREVIEW_TIMEOUT.  Rendered previews are cached by content
+        so identical previews are only rendered once.
+    '''
+    body = request.POST.get('body', '')
+    markup_type = request.POST.get('body_markup_type', DEFAULT_MARKUP_TYPE)
+    if markup_type not in dict(WIKI_MARKUP_TYPES):
+        return HttpResponseBadRequest('unknown markup type')
+    if len(body) > PREVIEW_MAX_SIZE:
+        return HttpResponse('too large to preview', status=413)
+
+    digest = hashlib.md5(body.encode('utf8')).hexdigest()
+    key = 'markupwiki_preview_%s_%s' % (markup_type, digest)
+    cache = rendercache.get_render_cache()
+    html = cache.get(key)
+    if html is None:
+        # rendering happens in the worker pool, links are added here since
+        # they can need the database
+        try:
+            html = workers.run(render_markup, (body, markup_type, False),
+                               timeout=PREVIEW_TIMEOUT, key=key)
+        except workers.WorkerTimeout:
+            return HttpResponse('preview timed out', status=503)
+        cache.set(key, html, rendercache.CACHE_SECONDS)
+    return HttpResponse(make_wiki_links(html))
+
+@require_POST
+@user_passes_test(is_moderator)
 @title_check
 def article_status(request, title):
     ''' POST-only view to update article status (staff-only)
     '''
-    article = get_object_or_404(Article, title=title)
+    article = get_object_or_404(Article, title_key=title_key(title))
     article.status = int(request.POST['status'])
     article.save()
 
     return redirect(article)
 
 @require_POST
-@user_passes_test(MODERATOR_TEST_FUNC)
+@user_passes_test(is_moderator)
 @title_check
+@rate_limited
 def revert(request, title):
     ''' POST-only view to revert article to a specific revision
     '''
-    article = get_object_or_404(Article, title=title)
+    article = get_object_or_404(Article, title_key=title_key(title))
     revision_id = int(request.POST['revision'])
     revision = get_object_or_404(article.versions, number=revision_id)
-    ArticleVersion.objects.create(article=article, author=request.user,
-                                  number=article.versions.latest().number,
-                                  comment='reverted to r%s' % revision_id,
-                                  body=revision.body)
+    article.add_version(ArticleVersion(author=request.user,
+                                       comment='reverted to r%s' % revision_id,
+                                       body=revision.restore_body()))
 
     return redirect(article)
 
 @require_POST
-@user_passes_test(MODERATOR_TEST_FUNC)
+@user_passes_test(is_moderator)
 @title_check
+@rate_limited
 def rename(request, title):
-    ''' POST-only view to rename article '''
-    article = get_object_or_404(Article, title=title)
-    new_title = request.POST['new_title']
-    article.title = new_title.replace(' ', '_')
-    article.save()
-    new_article = Article.objects.create(title=title, creator=request.user,
-                                         redirect_to=article)
+    ''' POST-only view to rename article
+
+        a redirect from the old title is left behind, a redirect without
+        history that is in the way of the new title is replaced
+    '''
+    article = get_object_or_404(Article, title_key=title_key(title))
+    new_title = canonicalize_title(request.POST['new_title'])
+    if not new_title or new_title == article.title:
+        return redirect(article)
+
+    existing = Article.objects.filter(title_key=title_key(new_title)).exclude(
+        pk=article.pk)
+    for other in existing:
+        if not other.redirect_to_id or other.latest_number >= 0:
+            messages.error(request, 'An article named %s already exists.' %
+                           new_title)
+            return redirect(article)
+
+    old_title = article.title
+    try:
+        with atomic():
+            existing.delete()
+            article.title = new_title
+            article.save()
+            # a change of case only keeps the title_key so needs no redirect
+            if title_key(old_title) != title_key(new_title):
+                Article.objects.create(title=old_title, creator=request.user,
+                                       redirect_to=article)
+    except (RedirectLoop, Article.DoesNotExist) as e:
+        messages.error(request, 'Could not rename %s: %s.' % (old_title, e))
+        return redirect('view_article', old_title)
     return redirect(article)
 
+def _history_page(request, article):
+    ''' return (versions, next_before) for a page of article's history
+
+        versions are newest first, starting below the ``before`` GET
+        parameter, and next_before is the value of ``before`` for the next
+        page (None if this is the last page)
+    '''
+    versions = article.versions.filter(removed=False).select_related(
+        'author').defer('body', '_body_rendered', 'body_delta').order_by(
+        '-number')
+    before = request.GET.get('before')
+    if before:
+        versions = versions.filter(number__lt=int(before))
+    versions = list(versions[:HISTORY_PAGE_SIZE + 1])
+    if len(versions) > HISTORY_PAGE_SIZE:
+        versions = versions[:HISTORY_PAGE_SIZE]
+        return versions, versions[-1].number
+    return versions, None
+
 @title_check
+@conditional_article
 def article_history(request, title):
-    article = get_object_or_404(Article, title=title)
-    versions = article.versions.filter(removed=False)
+    ''' list revisions of an article, newest first
+
+        GET parameters:
+            before - only show revisions numbered lower than this (optional)
+
+        Context:
+            article     - ``Article`` instance
+            versions    - ``ArticleVersion`` instances on this page (without
+                          their bodies)
+            next_before - value of ``before`` for the next page or None
+
+        Template:
+            history.html - default template used
+    '''
+    article = _get_article(request, title)
+    if article is None:
+        raise Http404()
+    article.editable = article.is_editable_by_user(request.user)
+    versions, next_before = _history_page(request, article)
     return render_to_response('markupwiki/history.html',
-                              {'article':article, 'versions':versions},
+                              {'article':article, 'versions':versions,
+                               'next_before': next_before},
                               context_instance=RequestContext(request))
 
+@title_check
+def article_history_json(request, title):
+    ''' JSON version of article_history, takes the same parameters '''
+    article = get_object_or_404(Article, title_key=title_key(title))
+    versions, next_before = _history_page(request, article)
+    data = {
+        'title': article.title,
+        'latest_number': article.latest_number,
+        'versions': [{'number': v.number,
+                      'author': v.author.username if v.author else None,
+                      'timestamp': v.timestamp.isoformat(),
+                      'comment': v.comment,
+                      'url': v.get_absolute_url()} for v in versions],
+        'next_before': next_before,
+    }
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
 @title_check
 def article_diff(request, title):
-    article = get_object_or_404(Article, title=title)
+    ''' compare two revisions of an article
+
+        GET parameters:
+            from, to - revision numbers to compare
+            mode     - one of full, context or inline (optional)
+
+        Context:
+            article   - ``Article`` instance
+            table     - html of the diff
+            truncated - True if the diff was too long to show in full
+            from, to  - revision numbers being compared
+            mode      - diff mode used
+            modes     - available diff modes
+
+        Template:
+            article_diff.html - default template used
+    '''
+    article = get_object_or_404(Article, title_key=title_key(title))
     from_id = int(request.GET['from'])
     to_id = int(request.GET['to'])
-    from_version = article.versions.get(number=from_id)
-    to_version = article.versions.get(number=to_id)
-    differ = HtmlDiff()
-    from_body = from_version.body.raw.split('\n')
-    to_body = to_version.body.raw.split('\n')
-    table = differ.make_table(from_body, to_body)
+    mode = request.GET.get('mode', DEFAULT_DIFF_MODE)
+    if mode not in DIFF_MODES:
+        mode = DEFAULT_DIFF_MODE
+    versions = dict((v.number, v) for v in
+                    article.versions.filter(number__in=(from_id, to_id)))
+    if from_id not in versions or to_id not in versions:
+        raise Http404()
+    table, truncated = get_version_diff(versions[from_id], versions[to_id],
+                                        mode)
     return render_to_response('markupwiki/article_diff.html',
                               {'article': article, 'table':table,
-                               'from': from_id, 'to':to_id},
+                               'truncated': truncated,
+                               'from': from_id, 'to':to_id,
+                               'mode': mode, 'modes': DIFF_MODES},
+                              context_instance=RequestContext(request))
+
+@title_check
+def article_backlinks(request, title):
+    ''' list the articles that link to an article ("what links here")
+
+        Context:
+            title    - title of the article being linked to
+            articles - articles linking to title
+
+        Template:
+            backlinks.html - default template used
+    '''
+    articles = Article.objects.filter(
+        links__target_title=title_key(title)).order_by(
+        'title').distinct()
+    return render_to_response('markupwiki/backlinks.html',
+                              {'title': title, 'articles': articles},
+                              context_instance=RequestContext(request))
+
+@title_check
+def section_index(request, title):
+    ''' list the articles directly below a section
+
+        GET parameters:
+            after - only list articles whose title sorts after this (optional)
+
+        Context:
+            section    - title of the section
+            articles   - ``Article`` instances on this page, each with a
+                         ``child_count`` of the articles below it
+            count      - number of articles in the section
+            next_after - value of ``after`` for the next page (None if this
+                         is the last page)
+
+        Template:
+            section.html - default template used
+    '''
+    # sections are matched on their title key like articles are
+    articles = Article.objects.filter(section=title_key(title)).order_by(
+        'title')
+    count = articles.count()
+    after = request.GET.get('after')
+    if after:
+        articles = articles.filter(title__gt=after)
+    articles = list(articles[:SECTION_PAGE_SIZE + 1])
+    next_after = None
+    if len(articles) > SECTION_PAGE_SIZE:
+        articles = articles[:SECTION_PAGE_SIZE]
+        next_after = articles[-1].title
+
+    child_counts = dict(Article.objects.filter(
+        section__in=[a.title_key for a in articles]).order_by().values_list(
+            'section').annotate(Count('pk')))
+    for article in articles:
+        article.child_count = child_counts.get(article.title_key, 0)
+
+    return render_to_response('markupwiki/section.html',
+                              {'section': title, 'articles': articles,
+                               'count': count, 'next_after': next_after},
+                              context_instance=RequestContext(request))
+
+def search(request):
+    ''' search the current version of every article
+
+        GET parameters:
+            q - search query
+
+        Context:
+            query   - the search query
+            results - list of (article, score, snippet) tuples
+
+        Template:
+            search.html - default template used
+    '''
+    query = request.GET.get('q', '').strip()
+    results = wiki_search.search(query) if query else []
+    return render_to_response('markupwiki/search.html',
+                              {'query': query, 'results': results},
                               context_instance=RequestContext(request))
@@ -0,0 +1,85 @@
+'''
+    bounded pool of threads for cpu heavy work done while handling a request
+
+    ``run`` hands a function to the pool and waits at most
+    MARKUPWIKI_WORKER_TIMEOUT seconds for its result.  At most
+    MARKUPWIKI_WORKER_THREADS functions run at once and at most as many again
+    wait for a thread; when the pool is full or the result doesn't arrive in
+    time WorkerTimeout is raised so the view can fall back to something
+    cheaper instead of tying up the process.  A function that times out keeps
+    running in its thread, so functions should store their result somewhere
+    (eg. the cache) for later requests.  Calls given the same key while one is
+    running share its result instead of running again.  Functions add their
+    ``markupwiki.instrumentation`` timings to the request that started them.
+
+    Functions run in the pool shouldn't use the database.
+'''
+
+import os
+import threading
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from markupwiki import instrumentation
+
+WORKER_THREADS = getattr(settings, 'MARKUPWIKI_WORKER_THREADS', 4)
+WORKER_TIMEOUT = getattr(settings, 'MARKUPWIKI_WORKER_TIMEOUT', 5.0)
+
+class WorkerTimeout(Exception):
+    ''' raised by run when the pool is full or the function took too long '''
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+_slots = threading.BoundedSemaphore(WORKER_THREADS * 2)
+# key -> AsyncResult of calls that haven't finished
+_running = {}
+
+def get_pool():
+    global _pool, _pool_pid
+    with _lock:
+        # threads don't survive a fork so each process needs its own pool
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(WORKER_THREADS)
+            _pool_pid = os.getpid()
+    return _pool
+
+def _call(func, args, key, timings):
+    instrumentation.set_timings(timings)
+    try:
+        return func(*args)
+    finally:
+        instrumentation.set_timings(None)
+        if key is not None:
+            with _lock:
+                _running.pop(key, None)
+        _slots.release()
+
+def run(func, args=(), timeout=None, key=None):
+    ''' return func(*args) computed in the pool, raises WorkerTimeout if that
+        takes longer than timeout (default MARKUPWIKI_WORKER_TIMEOUT)
+
+        if key is given and a call with the same key is still running its
+        result is waited for instead
+    '''
+    if timeout is None:
+        timeout = WORKER_TIMEOUT
+    pool = get_pool()
+    with _lock:
+        result = _running.get(key) if key is not None else None
+        if result is None:
+            if not _slots.acquire(False):
+                raise WorkerTimeout('all workers are busy')
+            try:
+                result = pool.apply_async(
+                    _call, (func, args, key, instrumentation.get_timings()))
+            except Exception:
+                _slots.release()
+                raise
+            if key is not None:
+                _running[key] = result
+    try:
+        return result.get(timeout)
+    except TimeoutError:
+        raise WorkerTimeout('%s took more than %s seconds' % (func.__name__,
+                                                              timeout))